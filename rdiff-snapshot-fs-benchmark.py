@@ -0,0 +1,609 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# This file is part of rdiff-snapshot-fs.
+#
+# rdiff-snapshot-fs is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program. If not, see <http://www.gnu.org/licenses/>.
+
+
+# Usage: ./rdiff-snapshot-fs-benchmark.py generate [options] <repository>
+#        ./rdiff-snapshot-fs-benchmark.py run [options] <repository>
+#        ./rdiff-snapshot-fs-benchmark.py memory [-n ENTRIES]
+#
+# Benchmarks for rdiff-snapshot-fs that run without mounting anything.
+# "generate" creates a synthetic rdiff-backup repository, and "run" drives
+# the filesystem's methods directly against it, reporting latencies,
+# throughput, os module calls and peak memory for each scenario. Given a
+# baseline from an earlier run (see --output), "run" fails if any scenario
+# got slower or bigger by more than the tolerance.
+
+import collections
+import gc
+import gzip
+import imp
+import json
+import optparse
+import os
+import random
+import resource
+import shutil
+import stat
+import struct
+import sys
+import time
+import traceback
+
+snapshotfs = imp.load_source(
+    "snapshotfs",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                 "rdiff-snapshot-fs.py"))
+
+TIMESTAMPS = ["2010-01-%02dT03:00:00-05:00" % day for day in range(1, 31)]
+
+# ----- Synthetic repositories -----
+
+def make_delta(basis_header_length, header, body_length):
+    """
+    Returns a librsync delta that replaces the first basis_header_length
+    bytes of the basis file with header and keeps the following body_length
+    bytes.
+    """
+    # The commands with 4-byte parameters.
+    literal_n4 = snapshotfs.RS_OP_LITERAL_N1 + 2
+    copy_n4_n4 = snapshotfs.RS_OP_COPY_N1_N1 + 4 * 2 + 2
+    delta = struct.pack(">I", snapshotfs.RS_DELTA_MAGIC)
+    delta += struct.pack(">BI", literal_n4, len(header)) + header
+    delta += struct.pack(">BII", copy_n4_n4, basis_header_length, body_length)
+    return delta + chr(snapshotfs.RS_OP_END)
+
+def write_file(path, data, compress = False):
+    if compress:
+        output = gzip.open(path, "wb")
+    else:
+        output = open(path, "wb")
+    with output:
+        output.write(data)
+
+def metadata_record(path, file_type, size = None, mtime = 0,
+                    permissions = 0644):
+    "Returns a record of a mirror_metadata file."
+    record = "File %s\n  Type %s\n" % (path or ".", file_type)
+    if size is not None:
+        record += "  Size %d\n" % size
+    return record + "  ModTime %d\n  Uid 1000\n  Gid 1000\n" \
+        "  Permissions %d\n" % (mtime, permissions)
+
+def generate_repository(repository_path, files, fanout, depth, snapshots,
+                        chain, changed, gzipped, deleted, added, file_size,
+                        huge_dir, metadata, seed):
+    """
+    Writes a synthetic rdiff-backup repository to repository_path.
+
+    The tree has depth levels of fanout subdirectories, with files spread
+    evenly over all the directories. A fraction changed of the files have a
+    new version in each of the last chain sessions, stored as reverse diffs,
+    except that a fraction gzipped of those start from a gzipped snapshot.
+    A fraction deleted of the files were deleted and a fraction added were
+    created in the last session. If huge_dir is set, the directory "huge"
+    holds that many more files, none of which changed.
+    """
+    random.seed(seed)
+    if os.path.exists(repository_path):
+        shutil.rmtree(repository_path)
+    data_path = os.path.join(repository_path, "rdiff-backup-data")
+    increments_path = os.path.join(data_path, "increments")
+    os.makedirs(increments_path)
+    timestamps = TIMESTAMPS[:snapshots]
+    snapshot_times = [snapshotfs.parse_timestamp(ts) for ts in timestamps]
+    latest = snapshots - 1
+    chain = min(chain, latest)
+    for timestamp in timestamps[:-1]:
+        write_file(os.path.join(data_path, "increments.%s.dir" % timestamp),
+                   "")
+    write_file(os.path.join(data_path,
+                            "current_mirror.%s.data" % timestamps[-1]),
+               "PID 0\n")
+    # The metadata of every file at each snapshot.
+    records = [[metadata_record("", "dir", mtime = snapshot_time,
+                                permissions = 0755)]
+               for snapshot_time in snapshot_times]
+
+    directories = [""]
+    level = [""]
+    for _ in range(depth):
+        level = [os.path.join(parent, "d%d" % i)
+                 for parent in level for i in range(fanout)]
+        directories.extend(level)
+    for directory in directories[1:]:
+        os.mkdir(os.path.join(increments_path, directory))
+        os.mkdir(os.path.join(repository_path, directory))
+        for snapshot in range(snapshots):
+            records[snapshot].append(metadata_record(
+                    directory, "dir", mtime = snapshot_times[0],
+                    permissions = 0755))
+    body = "".join(chr(random.randint(0, 255)) for _ in xrange(file_size))
+    paths = [os.path.join(directories[i % len(directories)], "f%06d" % i)
+             for i in xrange(files)]
+    if huge_dir:
+        os.mkdir(os.path.join(repository_path, "huge"))
+        for snapshot in range(snapshots):
+            records[snapshot].append(metadata_record(
+                    "huge", "dir", mtime = snapshot_times[0],
+                    permissions = 0755))
+        paths.extend(os.path.join("huge", "h%07d" % i)
+                     for i in xrange(huge_dir))
+    for (i, path) in enumerate(paths):
+        mirror_file = os.path.join(repository_path, path)
+        increments = os.path.join(increments_path, path)
+        # Version k of a file is the version in snapshot k.
+        def header(k):
+            return "%s version %d\n" % (path, k)
+        fate = random.random() if not path.startswith("huge") else 1
+        # The file exists in the given snapshots, and its content in
+        # snapshot k is version max(k, oldest_version).
+        versions = range(snapshots)
+        oldest_version = latest
+        if fate < deleted:
+            # Deleted in the last session.
+            versions = versions[:-1]
+            oldest_version = latest - 1
+            write_file("%s.%s.snapshot.gz" % (increments, timestamps[-2]),
+                       header(latest - 1) + body, compress = True)
+        elif fate < deleted + added:
+            # Created in the last session.
+            versions = versions[-1:]
+            write_file(mirror_file, header(latest) + body)
+            write_file("%s.%s.missing" % (increments, timestamps[-2]), "")
+        elif fate < deleted + added + changed:
+            # Changed in each of the last chain sessions.
+            write_file(mirror_file, header(latest) + body)
+            oldest_version = latest - chain
+            for k in range(latest - 1, oldest_version - 1, -1):
+                if k == oldest_version and random.random() < gzipped:
+                    write_file("%s.%s.snapshot.gz" % (increments,
+                                                      timestamps[k]),
+                               header(k) + body, compress = True)
+                else:
+                    write_file("%s.%s.diff.gz" % (increments, timestamps[k]),
+                               make_delta(len(header(k + 1)), header(k),
+                                          len(body)),
+                               compress = True)
+        else:
+            # Never changed.
+            write_file(mirror_file, header(latest) + body)
+        for snapshot in versions:
+            version = max(snapshot, oldest_version)
+            records[snapshot].append(metadata_record(
+                    path, "reg", len(header(version)) + len(body),
+                    snapshot_times[version]))
+    if metadata:
+        for (snapshot, timestamp) in enumerate(timestamps):
+            write_file(os.path.join(
+                    data_path, "mirror_metadata.%s.snapshot.gz" % timestamp),
+                       "".join(sorted(records[snapshot])), compress = True)
+    return len(paths)
+
+# ----- Scenarios -----
+
+def walk(fs, path, skip = ()):
+    """
+    Lists path and everything below it, calling getattr on every entry like
+    ls -lR would. Returns the number of entries.
+    """
+    entries = 0
+    names = [direntry.name for direntry in fs.readdir(path, 0)
+             if direntry.name not in (".", "..")]
+    for name in names:
+        if name in skip:
+            continue
+        child = path + "/" + name
+        entries += 1
+        if stat.S_ISDIR(fs.getattr(child).st_mode):
+            entries += walk(fs, child)
+    return entries
+
+def read_file(fs, path, block_size = 128 * 1024):
+    "Reads all of path, returning the number of bytes read."
+    handle = fs.open(path, os.O_RDONLY)
+    offset = 0
+    try:
+        while True:
+            data = fs.read(path, block_size, offset, handle)
+            if not data:
+                return offset
+            offset += len(data)
+    finally:
+        fs.release(path, os.O_RDONLY, handle)
+
+def scenario_cold_browse(fs, snapshots, options, prepared):
+    "Lists the whole oldest snapshot with empty caches."
+    return {"operations": walk(fs, "/" + snapshots[0], skip = ("huge",))}
+
+def scenario_scrub(fs, snapshots, options, prepared):
+    "Lists the same directory tree in every snapshot, newest first."
+    operations = 0
+    for snapshot in reversed(snapshots):
+        operations += walk(fs, "/%s/d0" % snapshot)
+    return {"operations": operations}
+
+def find_deep_chains(repository_path, snapshots, options):
+    """
+    Returns the relative paths of the files with the longest chains of diffs
+    in the oldest snapshot.
+    """
+    finder = snapshotfs.RdiffSnapshotFs(repository_path = repository_path)
+    candidates = []
+    pending = [[]]
+    while pending:
+        relative_path = pending.pop()
+        for (name, entry) in finder.get_deferred_dir(
+                snapshots[0], relative_path).items():
+            if entry.file_type == snapshotfs.DIRECTORY and name != "huge":
+                pending.append(relative_path + [name])
+            elif entry.file_type == snapshotfs.REGULAR_FILE:
+                candidates.append((-len(entry.diff_names),
+                                   relative_path + [name]))
+    finder.close()
+    candidates.sort()
+    return [relative_path for (_, relative_path)
+            in candidates[:options.reads]]
+
+def scenario_deep_chain(fs, snapshots, options, relative_paths):
+    """
+    Reads the files with the longest chains of diffs in the oldest snapshot
+    (found by find_deep_chains), with empty caches.
+    """
+    total_bytes = 0
+    operations = 0
+    for relative_path in relative_paths:
+        total_bytes += read_file(
+            fs, "/%s/%s" % (snapshots[0], "/".join(relative_path)))
+        operations += 1
+    return {"operations": operations, "bytes": total_bytes}
+
+def scenario_huge_dir(fs, snapshots, options, prepared):
+    """
+    Lists the huge directory of the oldest snapshot the way the kernel does,
+    in batches that resume from the last offset, then calls getattr on each
+    entry.
+    """
+    path = "/%s/huge" % snapshots[0]
+    names = []
+    offset = 0
+    while True:
+        batch = []
+        for direntry in fs.readdir(path, offset):
+            batch.append(direntry)
+            if len(batch) == 128:
+                break
+        if not batch:
+            break
+        names.extend(direntry.name for direntry in batch
+                     if direntry.name not in (".", ".."))
+        offset = batch[-1].offset
+        if not offset:
+            # This listing doesn't support offsets, so it was complete.
+            break
+    for name in names:
+        fs.getattr(path + "/" + name)
+    return {"operations": len(names)}
+
+SCENARIOS = collections.OrderedDict([
+    ("cold_browse", scenario_cold_browse),
+    ("scrub", scenario_scrub),
+    ("deep_chain", scenario_deep_chain),
+    ("huge_dir", scenario_huge_dir),
+    ])
+
+# Functions that set up scenarios before they are measured. They are given
+# the repository path, the snapshots and the options, and their result is
+# passed to the scenario.
+SCENARIO_SETUP = {
+    "deep_chain": find_deep_chains,
+    }
+
+# os functions whose calls are counted while a scenario runs.
+COUNTED_OS_CALLS = ("lstat", "stat", "fstat", "listdir", "open", "read",
+                    "pread", "lseek", "close")
+
+def count_os_calls(counts):
+    "Makes calls to the functions in COUNTED_OS_CALLS increment counts."
+    def counting(name, function):
+        def wrapper(*args, **kw):
+            counts[name] += 1
+            return function(*args, **kw)
+        return wrapper
+    for name in COUNTED_OS_CALLS:
+        if hasattr(os, name):
+            setattr(os, name, counting(name, getattr(os, name)))
+
+def run_scenario(repository_path, name, options):
+    """
+    Runs one scenario against a new filesystem and returns its results. Meant
+    to be run in a process of its own, so that it starts with cold caches
+    and its peak memory usage can be measured.
+    """
+    fs = snapshotfs.RdiffSnapshotFs(repository_path = repository_path)
+    fs.reconstruction_workers = options.workers
+    fs.configure()
+    snapshots = fs.get_snapshots()
+    prepared = None
+    if name in SCENARIO_SETUP:
+        prepared = SCENARIO_SETUP[name](repository_path, snapshots, options)
+    os_calls = collections.defaultdict(int)
+    count_os_calls(os_calls)
+    start = time.time()
+    try:
+        result = SCENARIOS[name](fs, snapshots, options, prepared)
+        seconds = time.time() - start
+        stats = fs.get_stats()
+    finally:
+        fs.close()
+    result["seconds"] = seconds
+    result["operations_per_second"] = result["operations"] / seconds
+    if "bytes" in result:
+        result["bytes_per_second"] = result["bytes"] / seconds
+    result["latency"] = dict(
+        (operation, dict((key, value) for (key, value) in histogram.items()
+                         if key != "buckets"))
+        for (operation, histogram) in stats["latency"].items())
+    result["os_calls"] = dict(os_calls)
+    result["peak_rss_kb"] = resource.getrusage(
+        resource.RUSAGE_SELF).ru_maxrss
+    return result
+
+def run_in_child(function, *args):
+    """
+    Calls function(*args) in a forked child process, returning its result,
+    which must be JSON-serializable.
+    """
+    (read_fd, write_fd) = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(read_fd)
+        try:
+            output = json.dumps({"result": function(*args)})
+        except:
+            output = json.dumps({"error": traceback.format_exc()})
+        with os.fdopen(write_fd, "w") as pipe:
+            pipe.write(output)
+        os._exit(0)
+    os.close(write_fd)
+    with os.fdopen(read_fd) as pipe:
+        output = json.loads(pipe.read())
+    os.waitpid(pid, 0)
+    if "error" in output:
+        raise RuntimeError(output["error"])
+    return output["result"]
+
+def format_result(name, result):
+    "Returns a human-readable summary of a scenario's results."
+    lines = ["%s: %d operations in %.3f s (%.1f/s)" % (
+            name, result["operations"], result["seconds"],
+            result["operations_per_second"])]
+    if "bytes" in result:
+        lines.append("  throughput: %.2f MiB/s" % (
+                result["bytes_per_second"] / (1024.0 * 1024)))
+    for (operation, latency) in sorted(result["latency"].items()):
+        lines.append("  %-26s n=%-7d mean=%.3f ms p99<=%.3f ms" % (
+                operation, latency["count"], latency["mean_ms"],
+                latency["p99_ms"]))
+    lines.append("  os calls: " + ", ".join(
+            "%s=%d" % item for item in sorted(result["os_calls"].items())))
+    lines.append("  peak RSS: %d KiB" % result["peak_rss_kb"])
+    return "\n".join(lines)
+
+# The results compared against a baseline.
+GATED_METRICS = ("seconds", "peak_rss_kb")
+
+def find_regressions(baseline, results, tolerance):
+    """
+    Returns a list of descriptions of the metrics in results that are worse
+    than in baseline by more than the fraction tolerance.
+    """
+    regressions = []
+    for (name, result) in sorted(results.items()):
+        if name not in baseline:
+            continue
+        for metric in GATED_METRICS:
+            old = baseline[name][metric]
+            new = result[metric]
+            if new > old * (1 + tolerance):
+                regressions.append("%s %s: %.3f -> %.3f (+%.0f%%)" % (
+                        name, metric, old, new, 100.0 * (new - old) / old))
+    return regressions
+
+# ----- Memory -----
+
+def get_memory_usage():
+    "Returns the memory used by this process, in bytes."
+    gc.collect()
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except IOError:
+        # Not Linux; the peak is the best we can do.
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+def make_directory_timeline(entries, directory):
+    """
+    Returns a DirectoryTimeline for a synthetic directory with the given
+    number of files. Every file is in the mirror; every third one has a few
+    diffs, and every tenth one was created during the period covered.
+    """
+    mirror_names = ["message-%08d.eml" % i for i in xrange(entries)]
+    records = []
+    for (i, name) in enumerate(mirror_names):
+        if i % 3 == 0:
+            for timestamp in TIMESTAMPS[i % 7:i % 7 + 4]:
+                records.append(("%s.%s.diff.gz" % (name, timestamp), name,
+                                timestamp, "diff.gz", 0100600, 512))
+        if i % 10 == 0:
+            timestamp = TIMESTAMPS[i % 20]
+            records.append(("%s.%s.missing" % (name, timestamp), name,
+                            timestamp, "missing", 0100600, 0))
+    return snapshotfs.DirectoryTimeline(
+        directory, mirror_names, os.path.join(
+            "/backup/rdiff-backup-data/increments", directory[1:]), records)
+
+def benchmark_memory(entries):
+    """
+    Measures the memory used per entry by a cached directory timeline, and
+    by the DeferredFile objects for one snapshot of it.
+    """
+    directory = "/backup/home/user/Maildir/cur"
+    base = get_memory_usage()
+    timeline = make_directory_timeline(entries, directory)
+    after_timeline = get_memory_usage()
+    file_info = timeline.get_files(
+        snapshotfs.parse_timestamp(TIMESTAMPS[10]))
+    after_files = get_memory_usage()
+    print "entries:                   %d" % entries
+    print "timeline bytes/entry:      %.1f" % (
+        float(after_timeline - base) / entries)
+    print "estimated bytes/entry:     %.1f" % (
+        float(timeline.estimate_size()) / entries)
+    print "DeferredFile bytes/entry:  %.1f" % (
+        float(after_files - after_timeline) / len(file_info))
+
+# ----- Commands -----
+
+def generate_main(args):
+    parser = optparse.OptionParser(
+        usage = "%prog generate [options] <repository>",
+        description = "Creates a synthetic rdiff-backup repository " +
+        "(replacing anything already there).")
+    parser.add_option("--files", type = "int", default = 2000,
+                      help = "number of files [default: %default]")
+    parser.add_option("--fanout", type = "int", default = 4,
+                      help = "subdirectories per directory [default: %default]")
+    parser.add_option("--depth", type = "int", default = 2,
+                      help = "levels of subdirectories [default: %default]")
+    parser.add_option("--snapshots", type = "int", default = 10,
+                      help = "number of snapshots, at most %d " % (
+                          len(TIMESTAMPS)) + "[default: %default]")
+    parser.add_option("--chain", type = "int", default = 8,
+                      help = "number of sessions in which changed files " +
+                      "changed [default: %default]")
+    parser.add_option("--changed", type = "float", default = 0.3,
+                      help = "fraction of files that changed " +
+                      "[default: %default]")
+    parser.add_option("--gzipped", type = "float", default = 0.1,
+                      help = "fraction of changed files whose oldest " +
+                      "version is a gzipped snapshot [default: %default]")
+    parser.add_option("--deleted", type = "float", default = 0.05,
+                      help = "fraction of files deleted in the last " +
+                      "session [default: %default]")
+    parser.add_option("--added", type = "float", default = 0.05,
+                      help = "fraction of files created in the last " +
+                      "session [default: %default]")
+    parser.add_option("--file-size", type = "int", default = 16384,
+                      help = "size of each file [default: %default]")
+    parser.add_option("--huge-dir", type = "int", default = 20000,
+                      help = "number of files in the huge directory " +
+                      "[default: %default]")
+    parser.add_option("--no-metadata", action = "store_false",
+                      dest = "metadata", default = True,
+                      help = "don't write mirror_metadata files")
+    parser.add_option("--seed", type = "int", default = 0,
+                      help = "random seed [default: %default]")
+    (options, args) = parser.parse_args(args)
+    if len(args) != 1:
+        parser.error("wrong number of arguments")
+    if not 2 <= options.snapshots <= len(TIMESTAMPS):
+        parser.error("--snapshots must be between 2 and %d" % len(TIMESTAMPS))
+    start = time.time()
+    count = generate_repository(
+        args[0], options.files, options.fanout, options.depth,
+        options.snapshots, options.chain, options.changed, options.gzipped,
+        options.deleted, options.added, options.file_size, options.huge_dir,
+        options.metadata, options.seed)
+    print "generated %d files in %.1f s" % (count, time.time() - start)
+
+def run_main(args):
+    parser = optparse.OptionParser(
+        usage = "%prog run [options] <repository>",
+        description = "Runs benchmark scenarios against a repository " +
+        "(usually one made by generate), each in a fresh process. " +
+        "Scenarios: " + ", ".join(SCENARIOS) + ".")
+    parser.add_option("-s", "--scenario", action = "append",
+                      help = "scenario to run (may be repeated) " +
+                      "[default: all]")
+    parser.add_option("--reads", type = "int", default = 50,
+                      help = "number of files read by deep_chain " +
+                      "[default: %default]")
+    parser.add_option("--workers", type = "int", default = 4,
+                      help = "reconstruction workers [default: %default]")
+    parser.add_option("-o", "--output", metavar = "FILE",
+                      help = "write the results to FILE as JSON")
+    parser.add_option("--baseline", metavar = "FILE",
+                      help = "compare the results with those in FILE and " +
+                      "fail if any are worse by more than the tolerance")
+    parser.add_option("--tolerance", type = "float", default = 0.25,
+                      help = "allowed fractional regression " +
+                      "[default: %default]")
+    (options, args) = parser.parse_args(args)
+    if len(args) != 1:
+        parser.error("wrong number of arguments")
+    repository_path = os.path.abspath(args[0])
+    names = options.scenario or list(SCENARIOS)
+    for name in names:
+        if name not in SCENARIOS:
+            parser.error("unknown scenario: " + name)
+    results = {}
+    for name in names:
+        results[name] = run_in_child(run_scenario, repository_path, name,
+                                     options)
+        print format_result(name, results[name])
+    if options.output:
+        with open(options.output, "w") as output:
+            json.dump(results, output, indent = 2, sort_keys = True)
+    if options.baseline:
+        with open(options.baseline) as baseline:
+            regressions = find_regressions(json.load(baseline), results,
+                                           options.tolerance)
+        for regression in regressions:
+            print "REGRESSION: " + regression
+        if regressions:
+            return 1
+    return 0
+
+def memory_main(args):
+    parser = optparse.OptionParser(
+        usage = "%prog memory [options]",
+        description = "Measures the memory used per cached directory entry.")
+    parser.add_option(
+        "-n", "--entries", type = "int", default = 200000,
+        help = "number of entries in the synthetic directory " +
+        "[default: %default]")
+    (options, args) = parser.parse_args(args)
+    if args:
+        parser.error("wrong number of arguments")
+    benchmark_memory(options.entries)
+
+COMMANDS = {
+    "generate": generate_main,
+    "run": run_main,
+    "memory": memory_main,
+    }
+
+def main(argv):
+    if len(argv) < 2 or argv[1] not in COMMANDS:
+        sys.stderr.write(
+            "Usage: %s generate|run|memory [options] ...\n" % argv[0])
+        return 2
+    return COMMANDS[argv[1]](argv[2:])
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -20,43 +20,82 @@
 
 
 # Usage:        ./rdiff-snapshot-fs.py <rdiff-backup-repository> <mountpoint>
+#               ./rdiff-snapshot-fs.py <directory-of-repositories> <mountpoint>
 # Unmount with: fusermount -u <mountpoint>
+# Export:       ./rdiff-snapshot-fs.py export <rdiff-backup-repository> \
+#                   <snapshot> <path> <destination>
 #
-# Requirements: rdiff-backup, FUSE Python bindings
+# Requirements: FUSE Python bindings
 
+import array
+import bisect
+import calendar
+import collections
+import contextlib
 import errno
+import functools
 import fuse
+import gzip
+import hashlib
+import itertools
+import json
+import multiprocessing
+import optparse
 import os
+import Queue
 import re
+import shutil
+import sqlite3
 import stat
-import subprocess
+import struct
 import sys
 import tempfile
+import threading
 import time
+import zlib
 
 fuse.fuse_python_api = (0, 2)
 
-# The interesting lines in the output of "rdiff-backup -l" (list all snapshots)
-# should match this pattern.
-INCREMENTS_PATTERN = re.compile(r"^    increments\.([-+0-9T:]+)\.dir   [A-Za-z0-9 :]+$")
+# rdiff-backup records each session with a marker file in rdiff-backup-data:
+# "increments.<timestamp>.dir" for every historical snapshot, and
+# "current_mirror.<timestamp>.data" for the snapshot in the mirror.
+SNAPSHOT_MARKER_PATTERN = re.compile(
+    r"^(increments|current_mirror)\.(.+)\.(dir|data)$")
+
+# Timestamps are W3C datetimes, e.g. "2009-09-17T00:01:23-07:00". With
+# --use-compatible-timestamps, rdiff-backup writes dashes instead of colons.
+TIMESTAMP_PATTERN = re.compile(
+    r"^([0-9]{4})-([0-9]{2})-([0-9]{2})" +
+    r"T([0-9]{2})[:-]([0-9]{2})[:-]([0-9]{2})" +
+    r"(Z|([-+])([0-9]{2})[:-]([0-9]{2}))$")
 
 # Increment files in the increments/ directory should match the following
 # pattern. We use the pattern to extract the interesting components from the
 # filename, an example of which might be
-# "foo.txt.2009-09-17T00:01:23-07:00.diff.gz".
+# "foo.txt.2009-09-17T00:01:23-07:00.diff.gz". The timestamp may have any UTC
+# offset, and may use dashes instead of colons (see TIMESTAMP_PATTERN).
 INCREMENT_FILE_PATTERN = re.compile(
     r"^(.*)\.([0-9]{4}-[0-9]{2}-[0-9]{2}" +
-    r"T[0-9]{2}:[0-9]{2}:[0-9]{2}-[0-9]{2}:[0-9]{2})" +
+    r"T[0-9]{2}[:-][0-9]{2}[:-][0-9]{2}(?:Z|[-+][0-9]{2}[:-][0-9]{2}))" +
     r"\.((diff|snapshot)\.gz|snapshot|dir|missing)$")
 
-def invoke_command(*cmd):
+def parse_timestamp(timestamp):
     """
-    Invoke cmd at the shell and return a list of its output lines.
+    Converts an rdiff-backup timestamp string to seconds since the epoch.
+    Raises ValueError if the string isn't a valid timestamp.
     """
-    s = subprocess.Popen(cmd, stdout=subprocess.PIPE,
-                         stderr=subprocess.PIPE, shell=False)
-    (stdout, stderr) = s.communicate()
-    return stdout.split("\n")
+    match = TIMESTAMP_PATTERN.match(timestamp)
+    if not match:
+        raise ValueError("Invalid timestamp: " + timestamp)
+    seconds = calendar.timegm(
+        tuple(int(field) for field in match.group(1, 2, 3, 4, 5, 6)))
+    if match.group(7) != "Z":
+        utc_offset = int(match.group(9)) * 3600 + int(match.group(10)) * 60
+        if match.group(8) == "+":
+            seconds -= utc_offset
+        else:
+            seconds += utc_offset
+    return seconds
 
 def get_path_components(path):
     """
@@ -66,6 +105,14 @@ def get_path_components(path):
     assert path.startswith("/")
     return path[1:].split("/")
 
+def get_inode(snapshot_ts, relative_path):
+    """
+    Returns a stable inode number for relative_path (a list of path
+    components) in the given snapshot. Inode 1 is reserved for the root.
+    """
+    digest = hashlib.md5(snapshot_ts + "/" + "/".join(relative_path)).digest()
+    return struct.unpack(">Q", digest[:8])[0] % (2 ** 63 - 2) + 2
+
 def is_root(components):
     return len(components) == 0 or components == [""]
 
@@ -88,10 +135,18 @@ def parse_increment_filename(filename):
         raise ValueError("Invalid increment filename: " + filename)
 
 # Possible file types
-NONEXISTENT = "NONEXISTENT"
-REGULAR_FILE = "REGULAR_FILE"
-DIRECTORY = "DIRECTORY"
-LINK = "LINK"
+NONEXISTENT = 0
+REGULAR_FILE = 1
+DIRECTORY = 2
+LINK = 3
+
+# Possible types of increment, as returned by parse_increment_filename, and
+# the small integer codes they are stored as.
+INCREMENT_TYPES = ("missing", "dir", "snapshot", "snapshot.gz", "diff.gz")
+(INCREMENT_MISSING, INCREMENT_DIR, INCREMENT_SNAPSHOT, INCREMENT_SNAPSHOT_GZ,
+ INCREMENT_DIFF_GZ) = range(len(INCREMENT_TYPES))
+INCREMENT_TYPE_CODES = dict(
+    (objtype, code) for (code, objtype) in enumerate(INCREMENT_TYPES))
 
 def get_file_type(stat_mode):
     if stat.S_ISREG(stat_mode):
@@ -101,9 +156,763 @@ def get_file_type(stat_mode):
     elif stat.S_ISLNK(stat_mode):
         return LINK
     else:
-        raise IOError("Unsupported mode: " + stat_mode)
+        raise IOError("Unsupported mode: %o" % stat_mode)
+
+# Reverse diffs (.diff.gz increments) are gzipped librsync deltas. A delta is
+# the magic number followed by a sequence of commands, each of which either
+# emits literal data or copies a range of the basis file (the newer version of
+# the file) to the output.
+RS_DELTA_MAGIC = 0x72730236
+RS_OP_END = 0x00
+RS_OP_LITERAL_1 = 0x01
+RS_OP_LITERAL_64 = 0x40
+RS_OP_LITERAL_N1 = 0x41
+RS_OP_LITERAL_N8 = 0x44
+RS_OP_COPY_N1_N1 = 0x45
+RS_OP_COPY_N8_N8 = 0x54
+# Parameter widths are encoded in the opcodes in this order.
+RS_PARAM_WIDTHS = (1, 2, 4, 8)
+RS_PARAM_FORMATS = { 1: ">B", 2: ">H", 4: ">I", 8: ">Q" }
+
+# Size of the buffers used when copying file data around.
+COPY_BUFFER_SIZE = 64 * 1024
+
+def read_exactly(source, size):
+    """
+    Reads exactly size bytes from the file object source, raising IOError on
+    a premature end of file.
+    """
+    data = source.read(size)
+    if len(data) != size:
+        raise IOError("Unexpected end of file in " + repr(source.name))
+    return data
+
+def read_int(source, width):
+    "Reads a big-endian unsigned integer that is width bytes long."
+    return struct.unpack(RS_PARAM_FORMATS[width],
+                         read_exactly(source, width))[0]
+
+def copy_range(source, dest, size):
+    "Copies size bytes from file object source to file object dest."
+    while size > 0:
+        data = read_exactly(source, min(size, COPY_BUFFER_SIZE))
+        dest.write(data)
+        size -= len(data)
+
+def apply_delta(basis, delta, dest):
+    """
+    Applies the librsync delta read from the file object delta to the
+    seekable file object basis, writing the result to the file object dest.
+    """
+    if read_int(delta, 4) != RS_DELTA_MAGIC:
+        raise IOError("Not a librsync delta: " + repr(delta.name))
+    while True:
+        op = ord(read_exactly(delta, 1))
+        if op == RS_OP_END:
+            return
+        elif RS_OP_LITERAL_1 <= op <= RS_OP_LITERAL_64:
+            copy_range(delta, dest, op)
+        elif RS_OP_LITERAL_N1 <= op <= RS_OP_LITERAL_N8:
+            length = read_int(delta, RS_PARAM_WIDTHS[op - RS_OP_LITERAL_N1])
+            copy_range(delta, dest, length)
+        elif RS_OP_COPY_N1_N1 <= op <= RS_OP_COPY_N8_N8:
+            (start_index, length_index) = divmod(op - RS_OP_COPY_N1_N1, 4)
+            start = read_int(delta, RS_PARAM_WIDTHS[start_index])
+            length = read_int(delta, RS_PARAM_WIDTHS[length_index])
+            basis.seek(start, os.SEEK_SET)
+            copy_range(basis, dest, length)
+        else:
+            raise IOError("Invalid librsync delta command %#x in %r"
+                          % (op, delta.name))
+
+def open_increment(filename):
+    """
+    Opens an increment (or mirror) file for reading, transparently
+    decompressing it if it is gzipped.
+    """
+    if filename.endswith(".gz"):
+        return gzip.open(filename, 'rb')
+    return open(filename, 'rb')
+
+class ProgressWriter():
+    """
+    Wraps a file object that is being written, reporting the amount of data
+    that has reached the file to a Reconstruction as the data is flushed.
+    """
+    def __init__(self, dest, reconstruction):
+        self.dest = dest
+        self.reconstruction = reconstruction
+        self.position = 0
+        self.unflushed = 0
+    def write(self, data):
+        self.dest.write(data)
+        self.position += len(data)
+        self.unflushed += len(data)
+        if self.unflushed >= COPY_BUFFER_SIZE:
+            self.flush()
+    def flush(self):
+        self.dest.flush()
+        self.unflushed = 0
+        self.reconstruction.advance_to(self.position)
+
+def restore_file(backing_file, diffs, dest_file, keep_intermediate = None,
+                 reconstruction = None):
+    """
+    Reconstructs a historical version of a file into dest_file by
+    decompressing backing_file (if necessary) and then applying each of the
+    reverse diffs in diffs, in order.
+
+    When the intermediate version produced by diffs[i] is no longer needed,
+    keep_intermediate(i, path), if given, may take ownership of it (e.g. by
+    moving it elsewhere) and return True; otherwise it is deleted.
+
+    If reconstruction (a Reconstruction) is given, it is told how much of
+    dest_file has been written as the data is produced.
+    """
+    def open_dest(filename):
+        dest = open(filename, 'wb')
+        if filename == dest_file and reconstruction is not None:
+            return (dest, ProgressWriter(dest, reconstruction))
+        return (dest, dest)
+    dest_dir = os.path.dirname(dest_file)
+    # Each delta needs random access to the previous version, so all but the
+    # last step write to an intermediate file next to dest_file.
+    intermediates = []
+    try:
+        if backing_file.endswith(".gz") or not diffs:
+            if diffs:
+                (fd, current) = tempfile.mkstemp(dir = dest_dir)
+                os.close(fd)
+                intermediates.append(current)
+            else:
+                current = dest_file
+            with open_increment(backing_file) as source:
+                (dest, writer) = open_dest(current)
+                with dest:
+                    shutil.copyfileobj(source, writer, COPY_BUFFER_SIZE)
+                    writer.flush()
+        else:
+            current = backing_file
+        for (i, diff) in enumerate(diffs):
+            if i == len(diffs) - 1:
+                output = dest_file
+            else:
+                (fd, output) = tempfile.mkstemp(dir = dest_dir)
+                os.close(fd)
+                intermediates.append(output)
+            with open(current, 'rb') as basis:
+                with open_increment(diff) as delta:
+                    (dest, writer) = open_dest(output)
+                    with dest:
+                        apply_delta(basis, delta, writer)
+                        writer.flush()
+            # The previous intermediate version is no longer needed.
+            if current in intermediates:
+                intermediates.remove(current)
+                if i == 0 or keep_intermediate is None \
+                        or not keep_intermediate(i - 1, current):
+                    os.unlink(current)
+            current = output
+    finally:
+        for filename in intermediates:
+            os.unlink(filename)
+
+class LatencyHistogram():
+    """
+    A histogram of latencies, with a bucket for each power of two
+    microseconds.
+    """
+    BUCKETS = 32
+    def __init__(self):
+        self.counts = [0] * self.BUCKETS
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+    def record(self, seconds):
+        # Bucket i holds latencies of less than 2**i microseconds.
+        bucket = min(int(seconds * 1e6).bit_length(), self.BUCKETS - 1)
+        self.counts[bucket] += 1
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+    def percentile(self, fraction):
+        "Returns an upper bound on the given percentile, in seconds."
+        threshold = fraction * self.count
+        seen = 0
+        for (bucket, count) in enumerate(self.counts):
+            seen += count
+            if count and seen >= threshold:
+                return min((1 << bucket) / 1e6, self.max)
+        return self.max
+    def to_dict(self):
+        "Returns a summary of the histogram, with times in milliseconds."
+        return {
+            "count": self.count,
+            "mean_ms": 1000 * self.total / self.count if self.count else 0,
+            "p50_ms": 1000 * self.percentile(0.5),
+            "p90_ms": 1000 * self.percentile(0.9),
+            "p99_ms": 1000 * self.percentile(0.99),
+            "max_ms": 1000 * self.max,
+            # Pairs of (upper bound in microseconds, count).
+            "buckets": [[1 << bucket, count]
+                        for (bucket, count) in enumerate(self.counts)
+                        if count],
+            }
+
+class Stats():
+    """
+    Counters and latency histograms describing the work done by the
+    filesystem, collected for /.stats.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.start_time = time.time()
+        self.counters = collections.defaultdict(int)
+        self.histograms = collections.defaultdict(LatencyHistogram)
+    def count(self, name, amount = 1):
+        "Adds amount to the counter name."
+        with self.lock:
+            self.counters[name] += amount
+    def record(self, name, seconds):
+        "Records a latency in the histogram name."
+        with self.lock:
+            self.histograms[name].record(seconds)
+    @contextlib.contextmanager
+    def timer(self, name):
+        "Records the time taken by a with block in the histogram name."
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.record(name, time.time() - start)
+    def to_dict(self):
+        "Returns the collected statistics."
+        with self.lock:
+            return {
+                "uptime": time.time() - self.start_time,
+                "counters": dict(self.counters),
+                "latency": dict((name, histogram.to_dict()) for
+                                (name, histogram) in self.histograms.items()),
+                }
+
+def timed(operation):
+    """
+    Decorates a method of an object with a stats attribute (a Stats), so that
+    each call's latency is recorded under operation. Calls that raise or
+    return a negative errno are also counted as errors. Generator methods
+    are timed until they are exhausted.
+    """
+    def decorate(method):
+        @functools.wraps(method)
+        def wrapper(self, *args, **kw):
+            start = time.time()
+            try:
+                result = method(self, *args, **kw)
+            except:
+                self.stats.count(operation + ".errors")
+                raise
+            finally:
+                self.stats.record(operation, time.time() - start)
+            if isinstance(result, int) and result < 0:
+                self.stats.count(operation + ".errors")
+            return result
+        return wrapper
+    return decorate
+
+def timed_generator(operation):
+    "Like timed, but for methods that return generators."
+    def decorate(method):
+        @functools.wraps(method)
+        def wrapper(self, *args, **kw):
+            start = time.time()
+            try:
+                for item in method(self, *args, **kw):
+                    yield item
+            except Exception:
+                # Not GeneratorExit: abandoning a listing part way (to resume
+                # it at an offset later) isn't an error.
+                self.stats.count(operation + ".errors")
+                raise
+            finally:
+                self.stats.record(operation, time.time() - start)
+        return wrapper
+    return decorate
+
+class SingleFlight():
+    """
+    Coalesces concurrent calls that have the same key, so that the work is
+    done only once and every caller gets the result (or the exception).
+    """
+    class Call():
+        def __init__(self):
+            self.done = threading.Event()
+            self.result = None
+            self.exc_info = None
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = {}
+    def do(self, key, function, *args):
+        "Returns function(*args), sharing the call with concurrent callers."
+        with self.lock:
+            call = self.calls.get(key)
+            is_leader = call is None
+            if is_leader:
+                call = self.calls[key] = SingleFlight.Call()
+        if is_leader:
+            try:
+                call.result = function(*args)
+            except:
+                call.exc_info = sys.exc_info()
+            with self.lock:
+                del self.calls[key]
+            call.done.set()
+        else:
+            call.done.wait()
+        if call.exc_info is not None:
+            raise call.exc_info[0], call.exc_info[1], call.exc_info[2]
+        return call.result
+
+class WorkerPool():
+    """
+    A fixed number of threads that run submitted jobs. This bounds the number
+    of expensive operations (e.g. reconstructions) that run at once.
 
-class DeferredFile():
+    The threads are started by the first submit, rather than when the pool is
+    created, so that they are started in the process that serves the mount
+    (FUSE forks to daemonize after the filesystem has been configured).
+    """
+    def __init__(self, num_workers):
+        self.num_workers = num_workers
+        self.queue = Queue.Queue()
+        self.threads = []
+        self.lock = threading.Lock()
+    def _start(self):
+        with self.lock:
+            if self.threads:
+                return
+            for _ in range(self.num_workers):
+                thread = threading.Thread(target = self._work)
+                thread.daemon = True
+                thread.start()
+                self.threads.append(thread)
+    def _work(self):
+        while True:
+            job = self.queue.get()
+            if job is None:
+                return
+            (function, args, call) = job
+            try:
+                call.result = function(*args)
+            except:
+                call.exc_info = sys.exc_info()
+            call.done.set()
+    def submit(self, function, *args):
+        """
+        Schedules function(*args) to run on a worker. Returns an object whose
+        done event is set when the job has finished.
+        """
+        self._start()
+        call = SingleFlight.Call()
+        self.queue.put((function, args, call))
+        return call
+    def close(self):
+        "Stops the workers once the queued jobs have run."
+        with self.lock:
+            threads = self.threads
+        for _ in threads:
+            self.queue.put(None)
+        for thread in self.threads:
+            thread.join()
+
+class Prefetcher():
+    """
+    Runs speculative jobs that warm caches ahead of demand, on its own small
+    set of threads so that they never compete with foreground requests for
+    the reconstruction workers.
+
+    Jobs belong to batches (see new_batch). Only jobs from the max_batches
+    most recent batches run; older ones are cancelled when they come up.
+    Jobs beyond max_pending are dropped. As with WorkerPool, the threads are
+    started by the first submit.
+    """
+    def __init__(self, num_workers, max_pending, max_batches):
+        self.num_workers = num_workers
+        self.queue = Queue.Queue(max_pending)
+        self.max_batches = max_batches
+        self.lock = threading.Lock()
+        self.batch = 0
+        self.completed = 0
+        self.cancelled = 0
+        self.dropped = 0
+        self.threads = []
+    def _start(self):
+        with self.lock:
+            if self.threads:
+                return
+            for _ in range(self.num_workers):
+                thread = threading.Thread(target = self._work)
+                thread.daemon = True
+                thread.start()
+                self.threads.append(thread)
+    def _work(self):
+        while True:
+            job = self.queue.get()
+            if job is None:
+                return
+            (batch, function, args) = job
+            with self.lock:
+                if batch <= self.batch - self.max_batches:
+                    self.cancelled += 1
+                    continue
+            try:
+                function(*args)
+            except Exception:
+                # Speculative work; any real problem will surface when the
+                # data is actually requested.
+                pass
+            with self.lock:
+                self.completed += 1
+    def new_batch(self):
+        "Starts a new batch of jobs, returning its identifier."
+        with self.lock:
+            self.batch += 1
+            return self.batch
+    def submit(self, batch, function, *args):
+        "Schedules function(*args) to run as part of batch, if there's room."
+        self._start()
+        try:
+            self.queue.put_nowait((batch, function, args))
+        except Queue.Full:
+            with self.lock:
+                self.dropped += 1
+    def close(self):
+        "Cancels the pending jobs and stops the threads."
+        while True:
+            try:
+                self.queue.get_nowait()
+            except Queue.Empty:
+                break
+        with self.lock:
+            threads = self.threads
+        for _ in threads:
+            self.queue.put(None)
+        for thread in threads:
+            thread.join()
+    def stats(self):
+        "Returns a dict of counters describing the prefetcher."
+        with self.lock:
+            return {
+                "pending": self.queue.qsize(),
+                "completed": self.completed,
+                "cancelled": self.cancelled,
+                "dropped": self.dropped,
+                }
+
+# The deflate format can't compress by more than a factor of about 1032, so
+# for compressed files smaller than this the size recorded (modulo 2^32) in the
+# gzip trailer is exact.
+GZIP_MAX_RATIO = 1032
+GZIP_TRAILER_SIZE = 8
+# Approximate memory used by a copy of a decompressor (mostly its 32 KiB
+# window).
+GZIP_CHECKPOINT_BYTES = 40 * 1024
+
+class GzipCursor():
+    """
+    A point in the decompression of a gzip file: the decompressor state after
+    producing position + len(buffer) bytes of output, where buffer is output
+    that hasn't been returned yet, and the compressed input it was given but
+    hasn't consumed (pending, which ends at compressed_position in the file).
+    """
+    def __init__(self, position, compressed_position, decompressor):
+        self.position = position
+        self.compressed_position = compressed_position
+        self.decompressor = decompressor
+        self.buffer = ""
+        self.pending = ""
+        # False if the decompressor may have more output without more input.
+        self.need_input = True
+
+class GzipIndex():
+    """
+    A random-access index into a gzip file.
+
+    As the file is decompressed, we record a checkpoint (uncompressed offset,
+    compressed offset and a copy of the decompressor state, including its
+    window) every span bytes of output. A read at any offset then only has to
+    decompress from the nearest preceding checkpoint. The index is extended
+    lazily as reads reach further into the file.
+
+    Each checkpoint costs about GZIP_CHECKPOINT_BYTES of memory. When there
+    would be more than max_checkpoints, every other one is dropped and the
+    span doubled.
+
+    Sequential reads don't go back to a checkpoint at all: the caller can keep
+    a GzipCursor from each read and pass it to the next one, which continues
+    from there.
+    """
+    def __init__(self, filename, span, max_checkpoints):
+        self.filename = filename
+        self.span = span
+        self.max_checkpoints = max(max_checkpoints, 2)
+        # Parallel lists of uncompressed offsets, compressed offsets and
+        # decompressor states. 16 + MAX_WBITS selects the gzip wrapper.
+        self.offsets = [0]
+        self.compressed_offsets = [0]
+        self.decompressors = [zlib.decompressobj(16 + zlib.MAX_WBITS)]
+        self.uncompressed_size = None
+        # Protects the checkpoint lists, which concurrent reads may extend.
+        self.lock = threading.Lock()
+        # Held while decompressing the whole file to find its size, so that
+        # concurrent callers wait for one decompression instead of each
+        # doing their own.
+        self.size_lock = threading.Lock()
+    def checkpoints(self):
+        return len(self.offsets)
+    def _add_checkpoint(self, cursor):
+        with self.lock:
+            if cursor.position < self.offsets[-1] + self.span:
+                return
+            self.offsets.append(cursor.position)
+            self.compressed_offsets.append(
+                cursor.compressed_position - len(cursor.pending))
+            self.decompressors.append(cursor.decompressor.copy())
+            if len(self.offsets) > self.max_checkpoints:
+                del self.offsets[1::2]
+                del self.compressed_offsets[1::2]
+                del self.decompressors[1::2]
+                self.span *= 2
+    def _decompress(self, source, offset, size, cursor = None):
+        """
+        Decompresses the file (an open file object) up to offset + size,
+        adding checkpoints along the way, and returns the data in [offset,
+        offset + size) and a cursor at the end of that data. If size is None,
+        decompresses to the end of the file and returns no data.
+
+        Decompression continues from cursor if it is at or before offset and
+        no checkpoint is closer; otherwise it starts from the nearest
+        checkpoint. The cursor is modified.
+        """
+        with self.lock:
+            i = bisect.bisect_right(self.offsets, offset) - 1
+            if cursor is None \
+                    or not self.offsets[i] <= cursor.position <= offset:
+                cursor = GzipCursor(self.offsets[i], self.compressed_offsets[i],
+                                    self.decompressors[i].copy())
+        # Output from offset onwards; pieces[0] starts at start.
+        pieces = []
+        start = end = cursor.position
+        if cursor.buffer:
+            pieces.append(cursor.buffer[offset - start:])
+            end += len(cursor.buffer)
+            start = offset
+        source.seek(cursor.compressed_position, os.SEEK_SET)
+        finished = False
+        while size is None or end < offset + size:
+            if cursor.need_input:
+                cursor.pending = source.read(COPY_BUFFER_SIZE)
+                cursor.compressed_position += len(cursor.pending)
+            data = cursor.decompressor.decompress(cursor.pending,
+                                                  COPY_BUFFER_SIZE)
+            if not data and not cursor.pending and cursor.need_input:
+                # End of the (possibly truncated) file.
+                finished = True
+                break
+            cursor.pending = cursor.decompressor.unconsumed_tail
+            # Output may still be buffered inside the decompressor if we got
+            # a full buffer back.
+            cursor.need_input = \
+                not cursor.pending and len(data) < COPY_BUFFER_SIZE
+            if size is not None and end + len(data) > offset:
+                if not pieces:
+                    start = max(offset, end)
+                pieces.append(data[start - end:] if end < start else data)
+            end += len(data)
+            cursor.position = end
+            if cursor.decompressor.unused_data:
+                # End of the gzip member.
+                finished = True
+                break
+            if end >= self.offsets[-1] + self.span:
+                self._add_checkpoint(cursor)
+        if finished:
+            self.uncompressed_size = end
+        if size is None:
+            return ("", cursor)
+        data = "".join(pieces)
+        # Keep whatever was decompressed beyond the requested range for the
+        # next read.
+        cursor.position = min(offset + size, end)
+        cursor.buffer = data[cursor.position - start:]
+        return (data[:cursor.position - start], cursor)
+    def read(self, size, offset, source = None, cursor = None):
+        """
+        Returns size bytes of uncompressed data starting at offset, and a
+        cursor from which the following data can be read. source is the
+        file, if already open.
+        """
+        if self.uncompressed_size is not None \
+                and offset >= self.uncompressed_size:
+            return ("", cursor)
+        if source is not None:
+            return self._decompress(source, offset, size, cursor)
+        with open(self.filename, 'rb') as source:
+            return self._decompress(source, offset, size, cursor)
+    def size(self):
+        "Returns the exact uncompressed size of the file."
+        if self.uncompressed_size is None:
+            compressed_size = os.stat(self.filename).st_size
+            if compressed_size * GZIP_MAX_RATIO < 2 ** 32:
+                # The trailer is reliable, so we can avoid decompressing.
+                with open(self.filename, 'rb') as source:
+                    source.seek(-4, os.SEEK_END)
+                    return struct.unpack("<I", source.read(4))[0]
+            with self.size_lock:
+                if self.uncompressed_size is None:
+                    with open(self.filename, 'rb') as source:
+                        self._decompress(source, self.offsets[-1], None)
+        return self.uncompressed_size
+
+class GzipIndexCache():
+    """
+    An LRU cache of GzipIndex objects, keyed by filename, holding at most
+    max_entries indexes and about max_bytes of checkpoints.
+    """
+    def __init__(self, max_entries, span, max_bytes):
+        self.max_entries = max_entries
+        self.span = span
+        self.max_checkpoints = max_bytes // GZIP_CHECKPOINT_BYTES
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+    def get(self, filename):
+        "Returns the (possibly new) index for filename."
+        with self.lock:
+            try:
+                index = self.entries.pop(filename)
+                self.hits += 1
+            except KeyError:
+                index = GzipIndex(filename, self.span, self.max_checkpoints)
+                self.misses += 1
+            self.entries[filename] = index
+            # Indexes grow as they are read, so the total is only enforced
+            # here; each index limits itself to max_checkpoints.
+            checkpoints = sum(entry.checkpoints()
+                              for entry in self.entries.values())
+            while len(self.entries) > self.max_entries \
+                    or (checkpoints > self.max_checkpoints
+                        and len(self.entries) > 1):
+                (_, evicted) = self.entries.popitem(last = False)
+                checkpoints -= evicted.checkpoints()
+            return index
+    def stats(self):
+        "Returns a dict of counters describing the cache."
+        with self.lock:
+            return {
+                "entries": len(self.entries),
+                "bytes": GZIP_CHECKPOINT_BYTES * sum(
+                    entry.checkpoints() for entry in self.entries.values()),
+                "hits": self.hits,
+                "misses": self.misses,
+                }
+
+class FileHandle():
+    """
+    A file opened through the filesystem, backed by a file descriptor for a
+    file on disk (in the mirror, an increment or a materialized file).
+
+    fuse-python passes the object returned from open back to read and
+    release, and applies its direct_io and keep_cache attributes.
+
+    If the file is still being reconstructed, reconstruction is the
+    Reconstruction that is writing it, and reads wait until the data they
+    ask for has been written.
+    """
+    def __init__(self, fd, direct_io = False, keep_cache = False,
+                 reconstruction = None):
+        self.fd = fd
+        self.direct_io = direct_io
+        self.keep_cache = keep_cache
+        self.reconstruction = reconstruction
+        # Without pread, the seek and read have to happen atomically.
+        self.lock = threading.Lock()
+    def read(self, size, offset):
+        if self.reconstruction is not None:
+            self.reconstruction.wait_for(offset + size)
+        if hasattr(os, "pread"):
+            return os.pread(self.fd, size, offset)
+        with self.lock:
+            os.lseek(self.fd, offset, os.SEEK_SET)
+            return os.read(self.fd, size)
+    def release(self):
+        os.close(self.fd)
+
+class GzipFileHandle():
+    """
+    A file opened through the filesystem whose data is read directly out of a
+    gzip file via its GzipIndex.
+    """
+    def __init__(self, gzip_index, direct_io = False, keep_cache = False):
+        self.gzip_index = gzip_index
+        self.direct_io = direct_io
+        self.keep_cache = keep_cache
+        self.source = open(gzip_index.filename, 'rb')
+        # Where the last read ended, so that sequential reads continue
+        # decompressing from there.
+        self.cursor = None
+        self.lock = threading.Lock()
+    def read(self, size, offset):
+        with self.lock:
+            (data, self.cursor) = self.gzip_index.read(
+                size, offset, self.source, self.cursor)
+            return data
+    def release(self):
+        self.source.close()
+
+class StreamFileHandle():
+    """
+    A handle on a generated file, whose data comes from an iterator of
+    strings that is consumed as the file is read sequentially. Reading from
+    an earlier offset starts the iterator over.
+
+    The size of the file isn't known in advance, so reads always go to the
+    filesystem (direct_io).
+    """
+    direct_io = True
+    keep_cache = False
+    def __init__(self, make_chunks):
+        self.make_chunks = make_chunks
+        self.lock = threading.Lock()
+        self._rewind()
+    def _rewind(self):
+        self.chunks = self.make_chunks()
+        # The data that has been generated but not yet read starts at offset
+        # self.start.
+        self.start = 0
+        self.buffer = ""
+    def read(self, size, offset):
+        with self.lock:
+            if offset < self.start:
+                self._rewind()
+            pieces = [self.buffer]
+            end = self.start + len(self.buffer)
+            while end < offset + size:
+                chunk = next(self.chunks, None)
+                if chunk is None:
+                    break
+                pieces.append(chunk)
+                end += len(chunk)
+            self.buffer = "".join(pieces)
+            # Data before the requested offset won't be needed again.
+            skip = min(offset - self.start, len(self.buffer))
+            self.buffer = self.buffer[skip:]
+            self.start += skip
+            return self.buffer[offset - self.start:offset - self.start + size]
+    def release(self):
+        pass
+
+class DeferredFile(object):
     """
     A DeferredFile object encapsulates all the information needed to
     reconstruct a particular version of a file, but only reconstructs the file
@@ -114,8 +923,14 @@ class DeferredFile():
     listing the increments in that directory. We can cache the DeferredFile
     objects so that inspecting all the files in the directory requires only one
     scan instead of one scan per file.
+
+    There can be a great many of these at once (e.g. in a deferred directory
+    or an export plan), so paths are kept as a directory, shared with the
+    other files from the same directory, and a basename.
     """
-    def __init__(self, name, backing_file, file_type):
+    __slots__ = ("name", "file_type", "backing_dir", "backing_name",
+                 "backing_file_is_increment", "increment_dir", "diff_names")
+    def __init__(self, name, backing_dir, file_type):
         self.name = name
         # These are the possibilities for the internal representation:
         #
@@ -127,102 +942,128 @@ class DeferredFile():
         # reverse diffs, to be applied in order, to obtain the file that we
         # actually want.
         #
-        # At present, whenever we have reverse diffs, we just invoke
-        # rdiff-backup to restore the file. In that case we only require the
-        # name of the corresponding increment file. So we don't really need to
-        # store the whole list of increments, only the most "recent" (oldest)
-        # one. But if we were ever to implement the file patching and
-        # restoration natively here, we would need to hang on to the full list.
-        self.backing_file = None
-        self.diffs = []
-        if backing_file:
-            self.backing_file = backing_file
-            self.backing_file_is_increment = False
+        # The reverse diffs are applied natively by restore_file, so we need
+        # to hang on to the full list of increments.
+        #
+        # A file in the mirror is backing_dir/name.
+        self.backing_dir = None
+        self.backing_name = None
+        self.backing_file_is_increment = False
+        self.increment_dir = None
+        self.diff_names = ()
+        if backing_dir:
+            self.backing_dir = backing_dir
+            self.backing_name = name
             self.file_type = file_type
         else:
             self.file_type = NONEXISTENT
-        # Store the most recent materialized file, and the associated path of
-        # the increment file. If the client asks for the same file again, we'll
-        # still have it lying around.
-        self.most_recent_increment = None
-        self.most_recent_materialized_file = None
+    @property
+    def backing_file(self):
+        "The path of the most recent full copy of the file."
+        if self.backing_name is None:
+            return None
+        return os.path.join(self.backing_dir, self.backing_name)
+    @property
+    def diffs(self):
+        "Paths of the reverse diffs to apply to the backing file, in order."
+        return [os.path.join(self.increment_dir, diff_name)
+                for diff_name in self.diff_names]
     def _clear_diffs(self):
         "Clear the backing file and the stack of diffs."
-        self.backing_file = None
-        self.diffs[:] = []
-    def apply(self, change_type, filename):
-        "Applies a change to this deferred file."
-        if change_type == 'missing':
+        self.backing_dir = None
+        self.backing_name = None
+        self.diff_names = ()
+    def apply(self, change_type, increment_dir, increment_name,
+              file_mode = None):
+        """
+        Applies a change (one of the INCREMENT_* codes) to this deferred file,
+        given the increment file's directory and name. file_mode, if given, is
+        the result of lstat on the increment file.
+        """
+        if change_type == INCREMENT_MISSING:
             # File does not exist at or before this increment.
             self.file_type = NONEXISTENT
             self._clear_diffs()
             return
-        self.file_exists = True
-        if change_type == 'dir':
+        if change_type == INCREMENT_DIR:
             # This is actually a directory.
             self.file_type = DIRECTORY
             self._clear_diffs()
             return
-        if change_type == 'snapshot' or change_type == 'snapshot.gz':
+        if change_type == INCREMENT_SNAPSHOT \
+                or change_type == INCREMENT_SNAPSHOT_GZ:
             # This is a snapshot (or a gzipped snapshot) of this file.
-            self.file_type = get_file_type(os.lstat(filename).st_mode)
+            if file_mode is None:
+                file_mode = os.lstat(
+                    os.path.join(increment_dir, increment_name)).st_mode
+            self.file_type = get_file_type(file_mode)
             # Since we have the full file data, the previous backing files and
             # any diffs we've seen in the interim are now irrelevant. Forget
             # them.
             self._clear_diffs()
-            self.backing_file = filename
+            self.backing_dir = increment_dir
+            self.backing_name = increment_name
             self.backing_file_is_increment = True
-        if change_type == 'diff.gz':
+        if change_type == INCREMENT_DIFF_GZ:
             # This is a reverse diff. Apply it.
-            self.diffs.append(filename)
-    def get_direntry(self):
+            self.increment_dir = increment_dir
+            self.diff_names += (increment_name,)
+    def get_direntry(self, ino = 0):
         """
         Returns a Direntry associated with this file, or raises KeyError if the
         file doesn't exist at the specified snapshot.
         """
         if self.file_type == NONEXISTENT:
             raise KeyError("File does not exist")
-        return fuse.Direntry(self.name)
-    def getattr(self):
+        return fuse.Direntry(self.name, ino = ino)
+    def is_gzip_snapshot(self):
+        """
+        Returns True if the data is exactly the contents of a gzipped snapshot
+        increment, with no diffs to apply.
         """
-        Returns the attributes associated with this file.
+        return not self.diff_names and self.backing_file_is_increment \
+            and self.backing_name.endswith(".snapshot.gz")
+    def getattr(self, gzip_index_cache = None, directory_mtime = 0, ino = 0):
+        """
+        Returns the attributes associated with this file. Directories don't
+        have any recorded attributes, so they get directory_mtime as their
+        mtime.
         """
         if self.file_type == DIRECTORY:
-            mtime = int(time.time())
             mode = stat.S_IFDIR | 0555
             size = 4096
-            return SnapshotFsStat(mtime, mode, size = size)
+            return SnapshotFsStat(directory_mtime, mode, size = size, ino = ino)
         elif self.file_type == LINK:
             assert len(self.diffs) == 0
             statresult = os.lstat(self.backing_file)
             return SnapshotFsStat(statresult.st_mtime,
                                   statresult.st_mode & ~0222,
-                                  statresult.st_size)
+                                  statresult.st_size, ino = ino)
         elif self.file_type == REGULAR_FILE:
-            # Computing the true size of the file may be expensive. Instead
-            # we'll use the size of the nearest available snapshot. Even
-            # determining the full size of a gzipped file may be expensive.
-            # There may not be any really good options here. It may be a good
-            # idea to allow the user to select between a "fast" mode and a
-            # "slow but correct" mode.
+            # The exact attributes come from rdiff-backup's mirror_metadata;
+            # this is only the fallback for sessions that didn't record any.
+            # Without reconstructing the file, the best we can do is the
+            # size, mode and mtime of the nearest available version (the
+            # uncompressed size, for a gzipped snapshot).
             statresult = os.lstat(self.backing_file)
             size = statresult.st_size
-            # TODO: figure out how reverse diffs affect the mode and mtime.
+            if gzip_index_cache is not None and self.is_gzip_snapshot():
+                size = gzip_index_cache.get(self.backing_file).size()
             # Disable write bit even if the backing file had it enabled.
             mode  = statresult.st_mode & ~0222
             mtime = statresult.st_mtime
-            return SnapshotFsStat(mtime, mode, size = size)
+            return SnapshotFsStat(mtime, mode, size = size, ino = ino)
     def readlink(self):
         """
         Returns the target associated with the current file, if it's a symlink.
         """
         assert self.file_type == LINK
         return os.readlink(self.backing_file)
-    def read(self, size, offset):
+    def needs_reconstruction(self):
         """
-        Returns file data.
+        Returns True if the file data has to be reconstructed, False if it can
+        be read directly from the backing file.
         """
-        assert self.file_type == REGULAR_FILE
         # The backing file can be either (1) in the mirror (the most recent
         # snapshot), or an increment file: either a (2) .snapshot or (3)
         # .snapshot.gz file somewhere in in the increments/ directory. In cases
@@ -230,230 +1071,1982 @@ class DeferredFile():
         # provide direct access to the underlying file.
         #
         # Otherwise, we have to reconstruct the file by possibly unzipping the
-        # backing file and then applying any reverse diffs. In this case we
-        # defer to rdiff-backup.
-        if len(self.diffs) == 0 \
-                and (not self.backing_file_is_increment \
-                         or self.backing_file.endswith(".snapshot")):
-            with open(self.backing_file, 'r') as source_file:
-                source_file.seek(offset, os.SEEK_SET)
-                return source_file.read(size)
-        else:
-            # If present, the last diff in our sequence represents the
-            # increment that identifies the data we want.
-            if len(self.diffs) > 0:
-                source_increment_file = self.diffs[-1]
-            else:
-                source_increment_file = self.backing_file
-
-            # Cache the file data so we don't have to reconstruct the same file
-            # if the client asks for the same file on the next request.
-            if source_increment_file != self.most_recent_increment:
-                # Remove the previous tempfile so we don't end up with an
-                # arbitrarily large number of tempfiles floating around.
-                if self.most_recent_materialized_file != None:
-                    os.unlink(self.most_recent_materialized_file)
-                (_, dest_file) = tempfile.mkstemp()
-                # Restore the file into dest_file using rdiff-backup.
-                invoke_command(
-                    "/usr/bin/rdiff-backup", "--force", source_increment_file,
-                    dest_file)
-                self.most_recent_increment = source_increment_file
-                self.most_recent_materialized_file = dest_file
-
-            with open(self.most_recent_materialized_file, 'r') as cached_file:
-                cached_file.seek(offset, os.SEEK_SET)
-                return cached_file.read(size)
+        # backing file and then applying any reverse diffs.
+        return len(self.diff_names) > 0 \
+            or (self.backing_file_is_increment \
+                    and not self.backing_name.endswith(".snapshot"))
+    def source_increment(self):
+        """
+        Returns the path of the increment file that identifies the data of this
+        version of the file.
+        """
+        # If present, the last diff in our sequence represents the increment
+        # that identifies the data we want.
+        if self.diff_names:
+            return os.path.join(self.increment_dir, self.diff_names[-1])
+        return self.backing_file
+    def open(self, materialization_cache, gzip_index_cache, **kw):
+        """
+        Returns a handle (FileHandle or GzipFileHandle) for reading the data
+        of this version of the file. Keyword arguments are passed on to the
+        handle.
+        """
+        if self.is_gzip_snapshot() \
+                and materialization_cache.get(self.backing_file) is None:
+            # Serve reads straight out of the compressed file rather than
+            # decompressing all of it first.
+            return GzipFileHandle(gzip_index_cache.get(self.backing_file), **kw)
+        if not self.needs_reconstruction():
+            return FileHandle(os.open(self.backing_file, os.O_RDONLY), **kw)
+        # Reads can start while the file is still being reconstructed.
+        (fd, reconstruction) = materialization_cache.open(
+            self.source_increment(), self.backing_file, self.diffs)
+        return FileHandle(fd, reconstruction = reconstruction, **kw)
 
 class SnapshotFsStat(fuse.Stat):
-    def __init__(self, mtime, mode, size = 4096):
+    def __init__(self, mtime, mode, size = 4096, uid = 0, gid = 0, ino = 0,
+                 nlink = None):
         self.st_mode = mode
-        self.st_ino = 0
+        self.st_ino = ino
         self.st_dev = 0
-        self.st_nlink = 2 if stat.S_ISDIR(mode) else 1
-        self.st_uid = 0
-        self.st_gid = 0
+        if nlink is None:
+            nlink = 2 if stat.S_ISDIR(mode) else 1
+        self.st_nlink = nlink
+        self.st_uid = uid
+        self.st_gid = gid
         self.st_size = size
         self.st_atime = mtime
         self.st_mtime = mtime
         self.st_ctime = mtime
 
+class DirectoryTimeline():
+    """
+    A DirectoryTimeline records the history of one directory across all
+    snapshots: the files currently in the mirror, and for each file, its
+    increments sorted by time.
+
+    It takes one scan of the directory to build, after which the
+    DeferredFile for any file at any snapshot is found by bisecting the
+    file's increments, instead of rescanning the directory for each snapshot.
+    Files in the mirror are only known by name until a DeferredFile is
+    needed for them.
+
+    Timelines are what the deferred directory cache holds, so they are
+    stored compactly: the names in one sorted list, and the increments in
+    flat arrays, with each increment's timestamp as an index into a table of
+    the distinct timestamps in the directory.
+    """
+    def __init__(self, mirror_dir, mirror_names, increment_dir,
+                 increment_records):
+        self.mirror_dir = mirror_dir
+        self.increment_dir = increment_dir
+        stamp_indexes = {}
+        increments = {}
+        for (_, basename, timestamp, objtype, file_mode, _) \
+                in increment_records:
+            if timestamp not in stamp_indexes:
+                stamp_indexes[timestamp] = len(stamp_indexes)
+            increments.setdefault(basename, []).append(
+                (parse_timestamp(timestamp), INCREMENT_TYPE_CODES[objtype],
+                 stamp_indexes[timestamp], file_mode))
+        self.timestamps = sorted(stamp_indexes, key = stamp_indexes.get)
+        # Every name that has existed in this directory, sorted, where
+        # in_mirror[i] is set if sorted_names[i] is in the mirror. The two
+        # sorted listings are merged directly into this list.
+        self.sorted_names = []
+        self.in_mirror = bytearray()
+        # The increments of sorted_names[i] are at positions starts[i] to
+        # starts[i + 1] of the other arrays, sorted by time.
+        self.starts = array.array('l', [0])
+        self.times = array.array('d')
+        self.change_types = bytearray()
+        self.stamps = array.array('l')
+        self.modes = array.array('l')
+        mirror_names = sorted(mirror_names)
+        history_names = sorted(increments)
+        (i, j) = (0, 0)
+        while i < len(mirror_names) or j < len(history_names):
+            if j == len(history_names) or i < len(mirror_names) \
+                    and mirror_names[i] < history_names[j]:
+                name = mirror_names[i]
+                self.in_mirror.append(1)
+                i += 1
+            else:
+                name = history_names[j]
+                in_mirror = i < len(mirror_names) and mirror_names[i] == name
+                self.in_mirror.append(in_mirror)
+                if in_mirror:
+                    i += 1
+                j += 1
+                for (increment_time, change_type, stamp, file_mode) \
+                        in sorted(increments[name]):
+                    self.times.append(increment_time)
+                    self.change_types.append(change_type)
+                    self.stamps.append(stamp)
+                    self.modes.append(-1 if file_mode is None else file_mode)
+            self.sorted_names.append(name)
+            self.starts.append(len(self.times))
+    def names(self):
+        "Returns a sorted list of every name that has been in this directory."
+        return self.sorted_names
+    def _find(self, name):
+        "Returns the position of name in sorted_names, or -1."
+        i = bisect.bisect_left(self.sorted_names, name)
+        if i < len(self.sorted_names) and self.sorted_names[i] == name:
+            return i
+        return -1
+    def iter_names(self, snapshot_time, start = 0):
+        """
+        Yields (position, name) for each name that existed at the given
+        snapshot time, in sorted order, starting from position start in
+        names(). Unlike get_file, this doesn't touch the filesystem.
+        """
+        for i in xrange(start, len(self.sorted_names)):
+            (low, high) = (self.starts[i], self.starts[i + 1])
+            if low < high:
+                # The earliest increment at or after the snapshot determines
+                # whether the file existed then.
+                k = bisect.bisect_left(self.times, snapshot_time, low, high)
+                if k < high:
+                    if self.change_types[k] != INCREMENT_MISSING:
+                        yield (i, self.sorted_names[i])
+                    continue
+            if self.in_mirror[i]:
+                yield (i, self.sorted_names[i])
+    def get_file(self, snapshot_time, name):
+        """
+        Returns the DeferredFile representing name at the given snapshot time
+        (in seconds since the epoch), or None if nothing by that name ever
+        existed.
+        """
+        i = self._find(name)
+        if i < 0:
+            return None
+        if self.in_mirror[i]:
+            try:
+                file_type = get_file_type(
+                    os.lstat(os.path.join(self.mirror_dir, name)).st_mode)
+            except OSError:
+                # Removed from the mirror since the directory was scanned.
+                file_type = NONEXISTENT
+            deferred_file = DeferredFile(name, self.mirror_dir, file_type)
+        else:
+            # Create a fake basefile we can apply diffs against.
+            deferred_file = DeferredFile(name, None, NONEXISTENT)
+        # Apply every increment made at or after the snapshot, in reverse
+        # chronological order.
+        (low, high) = (self.starts[i], self.starts[i + 1])
+        for k in xrange(high - 1,
+                        bisect.bisect_left(self.times, snapshot_time,
+                                           low, high) - 1, -1):
+            change_type = self.change_types[k]
+            file_mode = self.modes[k]
+            deferred_file.apply(
+                change_type, self.increment_dir,
+                "%s.%s.%s" % (name, self.timestamps[self.stamps[k]],
+                              INCREMENT_TYPES[change_type]),
+                None if file_mode < 0 else file_mode)
+        return deferred_file
+    def get_files(self, snapshot_time):
+        """
+        Returns a dict mapping basenames to DeferredFile objects for the given
+        snapshot time.
+        """
+        file_info = {}
+        for name in self.names():
+            file_info[name] = self.get_file(snapshot_time, name)
+        return file_info
+    def estimate_size(self):
+        """
+        Returns a rough estimate of the number of bytes of memory used by this
+        object. This only needs to be good enough to enforce a memory budget
+        on the deferred directory cache.
+        """
+        size = 512 + len(self.mirror_dir) + len(self.increment_dir)
+        for name in self.sorted_names:
+            # The string and the list slot.
+            size += 45 + len(name)
+        size += len(self.in_mirror) + len(self.starts) * 8
+        size += len(self.times) * 25
+        for timestamp in self.timestamps:
+            size += 45 + len(timestamp)
+        return size
+
+class CacheShares():
+    """
+    Tracks the keys and bytes that each namespace (e.g. repository) has in a
+    cache, so that eviction can take from the largest user first. A busy
+    namespace can then only push the others down to an equal share of the
+    cache, rather than flushing them out entirely.
+
+    Each namespace keeps its own LRU order, so choosing a victim only takes
+    time proportional to the number of namespaces. The owning cache
+    serializes calls, and must report every use of a key with touch.
+    """
+    def __init__(self):
+        # Maps key -> namespace.
+        self.namespaces = {}
+        # Maps namespace -> OrderedDict mapping key -> size, least recently
+        # used first.
+        self.keys = {}
+        # Maps namespace -> total size of its keys.
+        self.bytes = {}
+    def add(self, key, namespace, size):
+        self.namespaces[key] = namespace
+        if namespace not in self.keys:
+            self.keys[namespace] = collections.OrderedDict()
+            self.bytes[namespace] = 0
+        self.keys[namespace][key] = size
+        self.bytes[namespace] += size
+    def touch(self, key):
+        "Marks key as the most recently used of its namespace."
+        keys = self.keys[self.namespaces[key]]
+        keys[key] = keys.pop(key)
+    def remove(self, key):
+        namespace = self.namespaces.pop(key)
+        keys = self.keys[namespace]
+        self.bytes[namespace] -= keys.pop(key)
+        if not keys:
+            del self.keys[namespace]
+            del self.bytes[namespace]
+    def clear(self):
+        self.namespaces.clear()
+        self.keys.clear()
+        self.bytes.clear()
+    def choose_victim(self, keep = None):
+        """
+        Returns the key to evict: the least recently used key, other than
+        keep, of the namespace that uses the most bytes. Returns None if
+        there is none.
+        """
+        if not self.bytes:
+            return None
+        namespace = max(self.bytes, key = self.bytes.get)
+        # keep is a single key, so one of the first two will do.
+        for key in itertools.islice(self.keys[namespace], 2):
+            if key != keep:
+                return key
+        # The largest namespace holds nothing but keep; take from the next.
+        others = [other for other in self.bytes if other != namespace]
+        if not others:
+            return None
+        return next(iter(self.keys[max(others, key = self.bytes.get)]))
+
+class DeferredDirCache():
+    """
+    An LRU cache of deferred directories (DirectoryTimeline objects), keyed by
+    relative path.
+
+    The cache holds at most max_entries directories whose estimated total size
+    is at most max_bytes. It also remembers a bounded number of negative
+    results (paths that were found not to exist), so that repeated lookups of
+    missing files don't cause the containing directory to be rebuilt after it
+    has been evicted.
+
+    If namespace_of is given, it maps keys to namespaces (see CacheShares),
+    and eviction is fair between namespaces instead of strictly LRU.
+    """
+    def __init__(self, max_entries, max_bytes, max_negative_entries,
+                 namespace_of = None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.max_negative_entries = max_negative_entries
+        self.namespace_of = namespace_of
+        self.shares = None
+        if namespace_of is not None:
+            self.shares = CacheShares()
+        # Maps key -> (deferred directory, estimated size). Least recently
+        # used entries come first.
+        self.entries = collections.OrderedDict()
+        self.negative_entries = collections.OrderedDict()
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.negative_hits = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+    def get(self, key):
+        """
+        Returns the cached DirectoryTimeline for key, or None.
+        """
+        with self.lock:
+            return self._get(key)
+    def _get(self, key):
+        try:
+            (file_info, size) = self.entries.pop(key)
+        except KeyError:
+            self.misses += 1
+            return None
+        # Reinsert to mark the entry as most recently used.
+        self.entries[key] = (file_info, size)
+        if self.shares is not None:
+            self.shares.touch(key)
+        self.hits += 1
+        return file_info
+    def put(self, key, file_info):
+        "Adds a DirectoryTimeline to the cache, evicting old entries."
+        size = file_info.estimate_size()
+        with self.lock:
+            self._put(key, file_info, size)
+    def _put(self, key, file_info, size):
+        if key in self.entries:
+            self._remove(key)
+        if size > self.max_bytes:
+            # Caching this directory would flush everything else out.
+            return
+        self.entries[key] = (file_info, size)
+        self.total_bytes += size
+        if self.shares is not None:
+            self.shares.add(key, self.namespace_of(key), size)
+        while len(self.entries) > self.max_entries \
+                or self.total_bytes > self.max_bytes:
+            if self.shares is None:
+                victim = next(iter(self.entries))
+            else:
+                victim = self.shares.choose_victim(keep = key)
+            if victim is None:
+                break
+            self._remove(victim)
+            self.evictions += 1
+    def _remove(self, key):
+        (_, size) = self.entries.pop(key)
+        self.total_bytes -= size
+        if self.shares is not None:
+            self.shares.remove(key)
+    def is_negative(self, key):
+        "Returns True if key is known not to exist."
+        with self.lock:
+            if key in self.negative_entries:
+                self.negative_entries[key] = self.negative_entries.pop(key)
+                self.negative_hits += 1
+                return True
+            return False
+    def put_negative(self, key):
+        "Records that key does not exist."
+        with self.lock:
+            self.negative_entries.pop(key, None)
+            self.negative_entries[key] = True
+            while len(self.negative_entries) > self.max_negative_entries:
+                self.negative_entries.popitem(last = False)
+    def clear(self, namespace = None):
+        """
+        Forgets everything, or if namespace is given, only the keys of the
+        form (namespace, key) (see CacheNamespace).
+        """
+        with self.lock:
+            if namespace is None:
+                self.entries.clear()
+                self.negative_entries.clear()
+                self.total_bytes = 0
+                if self.shares is not None:
+                    self.shares.clear()
+                return
+            for key in [key for key in self.entries if key[0] == namespace]:
+                self._remove(key)
+            for key in [key for key in self.negative_entries
+                        if key[0] == namespace]:
+                del self.negative_entries[key]
+    def stats(self):
+        "Returns a dict of counters describing the cache."
+        with self.lock:
+            return self._stats()
+    def _stats(self):
+        return {
+            "entries": len(self.entries),
+            "bytes": self.total_bytes,
+            "negative_entries": len(self.negative_entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "negative_hits": self.negative_hits,
+            "evictions": self.evictions,
+            }
+
+class CacheNamespace():
+    """
+    A view of a DeferredDirCache shared by several repositories, in which
+    every key is qualified by namespace. Clearing the view only forgets the
+    keys in its namespace.
+    """
+    def __init__(self, cache, namespace):
+        self.cache = cache
+        self.namespace = namespace
+    def get(self, key):
+        return self.cache.get((self.namespace, key))
+    def put(self, key, file_info):
+        self.cache.put((self.namespace, key), file_info)
+    def is_negative(self, key):
+        return self.cache.is_negative((self.namespace, key))
+    def put_negative(self, key):
+        self.cache.put_negative((self.namespace, key))
+    def clear(self):
+        self.cache.clear(self.namespace)
+    def stats(self):
+        return self.cache.stats()
+
+def scan_increment_dir(increment_dir):
+    """
+    Lists the increment files in increment_dir. Returns a list of
+    (increment filename, basename, timestamp, type, mode, size) tuples and a
+    list of subdirectories, or raises OSError if the directory doesn't exist.
+    """
+    records = []
+    subdirs = []
+    for increment_file in os.listdir(increment_dir):
+        try:
+            statresult = os.lstat(os.path.join(increment_dir, increment_file))
+        except OSError:
+            continue
+        if stat.S_ISDIR(statresult.st_mode):
+            subdirs.append(increment_file)
+        elif stat.S_ISREG(statresult.st_mode):
+            try:
+                (basename, timestamp, objtype) = \
+                    parse_increment_filename(increment_file)
+            except ValueError:
+                continue
+            records.append((increment_file, basename, timestamp, objtype,
+                            statresult.st_mode, statresult.st_size))
+    return (records, subdirs)
+
+class IncrementIndex():
+    """
+    A persistent SQLite index of the increments/ tree.
+
+    The index records every increment file (already parsed into its
+    components) along with the mtime of each directory. Updating the index
+    after a backup session only rescans the directories whose mtime changed,
+    and building a deferred directory becomes a single query instead of a
+    listdir and an lstat per increment file.
+    """
+    SCHEMA = [
+        "CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)",
+        "CREATE TABLE IF NOT EXISTS dirs (path TEXT PRIMARY KEY, " +
+        "parent TEXT, mtime REAL)",
+        "CREATE INDEX IF NOT EXISTS dirs_by_parent ON dirs (parent)",
+        "CREATE TABLE IF NOT EXISTS increments (dir TEXT, " +
+        "filename TEXT, basename TEXT, timestamp TEXT, type TEXT, " +
+        "mode INTEGER, size INTEGER)",
+        "CREATE INDEX IF NOT EXISTS increments_by_dir ON increments (dir)",
+        ]
+    def __init__(self, increments_path, index_path):
+        self.increments_path = increments_path
+        # The connection is shared between FUSE threads, serialized by lock.
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(index_path, check_same_thread = False)
+        self.db.text_factory = str
+        for statement in self.SCHEMA:
+            self.db.execute(statement)
+        # Throw the index away if it was built for some other repository.
+        row = self.db.execute(
+            "SELECT value FROM meta WHERE key = 'increments_path'").fetchone()
+        if row is None or row[0] != increments_path:
+            self.db.execute("DELETE FROM dirs")
+            self.db.execute("DELETE FROM increments")
+            self.db.execute(
+                "INSERT OR REPLACE INTO meta VALUES ('increments_path', ?)",
+                (increments_path,))
+        self.db.commit()
+    def update(self):
+        """
+        Brings the index up to date with the increments/ tree, rescanning
+        only directories that have changed. Returns the number of directories
+        that were rescanned.
+        """
+        with self.lock:
+            return self._update()
+    def _update(self):
+        known = dict(self.db.execute("SELECT path, mtime FROM dirs"))
+        seen = set()
+        rescanned = 0
+        stack = [("", None)]
+        while stack:
+            (path, parent) = stack.pop()
+            full_path = os.path.join(self.increments_path, *path.split("/"))
+            try:
+                mtime = os.lstat(full_path).st_mtime
+            except OSError:
+                continue
+            seen.add(path)
+            if known.get(path) == mtime:
+                subdirs = [row[0] for row in self.db.execute(
+                        "SELECT path FROM dirs WHERE parent = ?", (path,))]
+            else:
+                try:
+                    (records, subdir_names) = scan_increment_dir(full_path)
+                except OSError:
+                    continue
+                rescanned += 1
+                self.db.execute("DELETE FROM increments WHERE dir = ?",
+                                (path,))
+                self.db.executemany(
+                    "INSERT INTO increments VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    [(path,) + record for record in records])
+                self.db.execute(
+                    "INSERT OR REPLACE INTO dirs VALUES (?, ?, ?)",
+                    (path, parent, mtime))
+                subdirs = [(path + "/" + name) if path else name
+                           for name in subdir_names]
+            for subdir in subdirs:
+                stack.append((subdir, path))
+        # Forget directories that have been removed.
+        for path in set(known) - seen:
+            self.db.execute("DELETE FROM dirs WHERE path = ?", (path,))
+            self.db.execute("DELETE FROM increments WHERE dir = ?", (path,))
+        self.db.commit()
+        return rescanned
+    def list_subdirs(self, relative_path):
+        """
+        Returns the names of the subdirectories of the directory relative_path
+        (a list of path components).
+        """
+        path = "/".join(relative_path)
+        with self.lock:
+            return [row[0].rsplit("/", 1)[-1] for row in self.db.execute(
+                    "SELECT path FROM dirs WHERE parent = ?", (path,))]
+    def list_dir(self, relative_path):
+        """
+        Returns the increment records for the directory relative_path (a list
+        of path components), in the same format as scan_increment_dir, or None
+        if there is no such directory.
+        """
+        path = "/".join(relative_path)
+        with self.lock:
+            if self.db.execute("SELECT 1 FROM dirs WHERE path = ?",
+                               (path,)).fetchone() is None:
+                return None
+            return self.db.execute(
+                "SELECT filename, basename, timestamp, type, mode, size " +
+                "FROM increments WHERE dir = ?", (path,)).fetchall()
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+# rdiff-backup records the metadata of every file in each session in
+# rdiff-backup-data. The most recent session has a full snapshot; older ones
+# are usually stored as diffs against the next newer session.
+METADATA_FILE_PATTERN = re.compile(
+    r"^mirror_metadata\.(.+)\.(snapshot|diff)(\.gz)?$")
+
+# The line that starts each record.
+METADATA_FILE_LINE_PATTERN = re.compile(r"^File ([^\n]*)\n", re.MULTILINE)
+
+METADATA_FILE_TYPES = {
+    "reg": stat.S_IFREG,
+    "dir": stat.S_IFDIR,
+    "sym": stat.S_IFLNK,
+    "fifo": stat.S_IFIFO,
+    "sock": stat.S_IFSOCK,
+    "dev": stat.S_IFCHR,
+    }
+
+# The attributes of a file at a particular snapshot.
+FileMetadata = collections.namedtuple(
+    "FileMetadata", "mode size mtime uid gid inode nlink")
+
+def unquote_metadata_path(quoted):
+    "Undoes the escaping rdiff-backup applies to paths in metadata files."
+    return re.sub(r"\\(.)",
+                  lambda match: "\n" if match.group(1) == "n" \
+                      else match.group(1),
+                  quoted)
+
+def make_file_metadata(fields):
+    """
+    Converts the fields of a metadata record into a FileMetadata, or returns
+    None if the record says the file doesn't exist.
+    """
+    file_type = fields.get("Type")
+    if file_type not in METADATA_FILE_TYPES:
+        return None
+    mode = METADATA_FILE_TYPES[file_type]
+    if file_type == "dev" and fields.get("DeviceNum", "").startswith("b"):
+        mode = stat.S_IFBLK
+    mode |= int(fields.get("Permissions", 0))
+    # Directories don't have a recorded size.
+    default_size = 4096 if file_type == "dir" else 0
+    return FileMetadata(mode = mode,
+                        size = int(fields.get("Size", default_size)),
+                        mtime = int(fields.get("ModTime", 0)),
+                        uid = int(fields.get("Uid", 0)),
+                        gid = int(fields.get("Gid", 0)),
+                        inode = int(fields.get("Inode", 0)),
+                        nlink = int(fields.get("NumHardLinks", 1)))
+
+def parse_metadata_records(source):
+    """
+    Parses a mirror_metadata file, yielding (relative path, FileMetadata)
+    pairs. The FileMetadata is None if the file didn't exist.
+    """
+    path = None
+    fields = {}
+    for line in source:
+        line = line.rstrip("\n")
+        if line.startswith("File "):
+            if path is not None:
+                yield (path, make_file_metadata(fields))
+            path = unquote_metadata_path(line[5:])
+            fields = {}
+        elif line.startswith("  ") and path is not None:
+            (key, _, value) = line[2:].partition(" ")
+            fields[key] = value
+    if path is not None:
+        yield (path, make_file_metadata(fields))
+
+class MetadataDirectory():
+    """
+    The FileMetadata of the files in one directory at one snapshot, as a dict
+    mapping names to FileMetadata. Cached in the DeferredDirCache, so that it
+    counts against the same memory budget as the directory timelines.
+    """
+    def __init__(self, records):
+        self.records = records
+    def estimate_size(self):
+        "Returns a rough estimate of the memory used by this object."
+        size = 256 + sys.getsizeof(self.records)
+        for (name, file_metadata) in self.records.iteritems():
+            # The name, the tuple and its (mostly large) integers.
+            size += 45 + len(name) + 120 + 24 * len(file_metadata)
+        return size
+
+class MirrorMetadata():
+    """
+    Provides the exact attributes of files at each snapshot, as recorded by
+    rdiff-backup in its mirror_metadata files, without having to reconstruct
+    any file data.
+
+    Records in a metadata file are sorted by path, so the records of the
+    files in a directory form a few contiguous runs (one more than the number
+    of its subdirectories). The first time a metadata file is used, it is
+    streamed once to record the (uncompressed) byte range of each run in an
+    SQLite database on disk. After that, looking up a directory only reads
+    and parses its runs: from the nearest newer full metadata snapshot, and
+    from each of the diffs leading back to the requested snapshot.
+
+    The metadata of each directory that was looked up is kept in cache (a
+    DeferredDirCache), and gzipped metadata files are read through
+    gzip_index_cache. If db_path is None the database is a temporary file.
+    """
+    SCHEMA = [
+        "CREATE TABLE IF NOT EXISTS metadata_files (id INTEGER PRIMARY KEY, " +
+        "filename TEXT UNIQUE, size INTEGER, mtime REAL)",
+        "CREATE TABLE IF NOT EXISTS metadata_runs (file INTEGER, dir TEXT, " +
+        "start INTEGER, end INTEGER)",
+        "CREATE INDEX IF NOT EXISTS metadata_runs_by_dir " +
+        "ON metadata_runs (file, dir)",
+        ]
+    # Number of runs to insert into the database at once while indexing.
+    INSERT_BATCH = 10000
+    def __init__(self, data_path, db_path, cache, gzip_index_cache):
+        self.data_path = data_path
+        self.cache = cache
+        self.gzip_index_cache = gzip_index_cache
+        self.temp_db_path = None
+        if db_path is None:
+            (fd, db_path) = tempfile.mkstemp(prefix = "rdiff-snapshot-fs-",
+                                             suffix = ".sqlite")
+            os.close(fd)
+            self.temp_db_path = db_path
+        self.files = None
+        # The connection is shared between FUSE threads, serialized by lock.
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(db_path, check_same_thread = False)
+        self.db.text_factory = str
+        for statement in self.SCHEMA:
+            self.db.execute(statement)
+        self.db.commit()
+        self.indexing = SingleFlight()
+        self.loads = SingleFlight()
+    def invalidate(self):
+        """
+        Forgets the list of metadata files, e.g. after a new backup session.
+        The cached directories are expected to be cleared along with the
+        rest of the cache.
+        """
+        with self.lock:
+            self.files = None
+    def close(self):
+        with self.lock:
+            self.db.close()
+        if self.temp_db_path is not None:
+            os.unlink(self.temp_db_path)
+    def _list_files(self):
+        """
+        Returns a list of (time, kind, path) tuples for the metadata files in
+        the repository, sorted chronologically.
+        """
+        with self.lock:
+            if self.files is not None:
+                return self.files
+        files = []
+        for filename in os.listdir(self.data_path):
+            match = METADATA_FILE_PATTERN.match(filename)
+            if not match:
+                continue
+            try:
+                snapshot_time = parse_timestamp(match.group(1))
+            except ValueError:
+                continue
+            files.append((snapshot_time, match.group(2),
+                          os.path.join(self.data_path, filename)))
+        files.sort()
+        with self.lock:
+            # Forget the indexes of metadata files that no longer exist
+            # (rdiff-backup replaces the newest snapshot with a diff).
+            paths = set(path for (_, _, path) in files)
+            for (file_id, filename) in self.db.execute(
+                    "SELECT id, filename FROM metadata_files").fetchall():
+                if filename not in paths:
+                    self.db.execute("DELETE FROM metadata_runs WHERE file = ?",
+                                    (file_id,))
+                    self.db.execute("DELETE FROM metadata_files WHERE id = ?",
+                                    (file_id,))
+            self.db.commit()
+            self.files = files
+        return files
+    def _find_files(self, snapshot_time):
+        """
+        Returns the full metadata snapshot and the list of diffs (newest
+        first) that give the metadata at snapshot_time, or None if the
+        repository doesn't have the necessary metadata files.
+        """
+        files = [(file_time, kind, path)
+                 for (file_time, kind, path) in self._list_files()
+                 if file_time >= snapshot_time]
+        if not files or files[0][0] != snapshot_time:
+            # No metadata was recorded for this session.
+            return None
+        # Find the oldest full snapshot at or after the requested time, and
+        # the diffs leading back from it to the requested time.
+        diffs = []
+        for (file_time, kind, path) in files:
+            if kind == "snapshot":
+                return (path, diffs[::-1])
+            diffs.append(path)
+        return None
+    def _open(self, filename):
+        "Returns a handle for reading the (uncompressed) data of filename."
+        if filename.endswith(".gz"):
+            return GzipFileHandle(self.gzip_index_cache.get(filename))
+        return FileHandle(os.open(filename, os.O_RDONLY))
+    def _get_file_id(self, filename):
+        """
+        Returns the id of filename in the database, indexing the file first
+        if it hasn't been indexed since it last changed.
+        """
+        statresult = os.stat(filename)
+        with self.lock:
+            row = self.db.execute(
+                "SELECT id, size, mtime FROM metadata_files " +
+                "WHERE filename = ?", (filename,)).fetchone()
+        if row is not None and row[1:] == (statresult.st_size,
+                                           statresult.st_mtime):
+            return row[0]
+        return self.indexing.do(filename, self._index_file, filename,
+                                statresult)
+    def _index_file(self, filename, statresult):
+        "Records the runs of each directory in filename; returns its id."
+        with self.lock:
+            self.db.execute(
+                "DELETE FROM metadata_runs WHERE file IN " +
+                "(SELECT id FROM metadata_files WHERE filename = ?)",
+                (filename,))
+            self.db.execute("DELETE FROM metadata_files WHERE filename = ?",
+                            (filename,))
+            # The size is filled in once all the runs are in, so that an
+            # interrupted indexing isn't mistaken for a complete one.
+            file_id = self.db.execute(
+                "INSERT INTO metadata_files (filename, size, mtime) " +
+                "VALUES (?, -1, ?)", (filename, statresult.st_mtime)).lastrowid
+        runs = []
+        def add_run(directory, start, end):
+            runs.append((file_id, directory, start, end))
+            if len(runs) >= self.INSERT_BATCH:
+                with self.lock:
+                    self.db.executemany(
+                        "INSERT INTO metadata_runs VALUES (?, ?, ?, ?)", runs)
+                del runs[:]
+        current_dir = None
+        run_start = 0
+        # The data from offset on hasn't been scanned yet, because it doesn't
+        # end in a complete line.
+        offset = 0
+        partial = ""
+        handle = self._open(filename)
+        try:
+            while True:
+                data = handle.read(16 * COPY_BUFFER_SIZE, offset + len(partial))
+                if not data:
+                    break
+                data = partial + data
+                for match in METADATA_FILE_LINE_PATTERN.finditer(data):
+                    # Quoting doesn't affect slashes, so the quoted directory
+                    # only needs unquoting when a new run starts.
+                    directory = match.group(1).rpartition("/")[0]
+                    if directory != current_dir:
+                        if current_dir is not None:
+                            add_run(unquote_metadata_path(current_dir),
+                                    run_start, offset + match.start())
+                        current_dir = directory
+                        run_start = offset + match.start()
+                scanned = data.rfind("\n") + 1
+                partial = data[scanned:]
+                offset += scanned
+        finally:
+            handle.release()
+        if current_dir is not None:
+            add_run(unquote_metadata_path(current_dir), run_start,
+                    offset + len(partial))
+        with self.lock:
+            self.db.executemany(
+                "INSERT INTO metadata_runs VALUES (?, ?, ?, ?)", runs)
+            self.db.execute("UPDATE metadata_files SET size = ? WHERE id = ?",
+                            (statresult.st_size, file_id))
+            self.db.commit()
+        return file_id
+    def _read_directory(self, filename, directory):
+        """
+        Returns a dict mapping the names of the files in directory to their
+        FileMetadata (None if the file doesn't exist) in metadata file
+        filename.
+        """
+        file_id = self._get_file_id(filename)
+        with self.lock:
+            runs = self.db.execute(
+                "SELECT start, end FROM metadata_runs " +
+                "WHERE file = ? AND dir = ? ORDER BY start",
+                (file_id, directory)).fetchall()
+        records = {}
+        if not runs:
+            return records
+        handle = self._open(filename)
+        try:
+            for (start, end) in runs:
+                lines = handle.read(end - start, start).splitlines(True)
+                for (path, file_metadata) in parse_metadata_records(lines):
+                    records[path.rpartition("/")[2]] = file_metadata
+        finally:
+            handle.release()
+        return records
+    def _load(self, snapshot_time, directory):
+        """
+        Computes the metadata of the files in directory at snapshot_time, or
+        returns None if the repository doesn't have the necessary metadata
+        files.
+        """
+        found = self._find_files(snapshot_time)
+        if found is None:
+            return None
+        (base, diffs) = found
+        records = dict(
+            (name, file_metadata) for (name, file_metadata)
+            in self._read_directory(base, directory).iteritems()
+            if file_metadata is not None)
+        for diff in diffs:
+            for (name, file_metadata) in \
+                    self._read_directory(diff, directory).iteritems():
+                if file_metadata is None:
+                    records.pop(name, None)
+                else:
+                    records[name] = file_metadata
+        return MetadataDirectory(records)
+    def get_directory(self, snapshot_ts, directory):
+        """
+        Returns the MetadataDirectory for directory (a path relative to the
+        repository, "" for the top level) at the given snapshot, or None if
+        it isn't known.
+        """
+        key = ("mirror_metadata", parse_timestamp(snapshot_ts), directory)
+        metadata = self.cache.get(key)
+        if metadata is None:
+            if self.cache.is_negative(key):
+                return None
+            # Concurrent requests for the same directory share one load.
+            metadata = self.loads.do(key, self._load, key[1], directory)
+            if metadata is None:
+                self.cache.put_negative(key)
+            else:
+                self.cache.put(key, metadata)
+        return metadata
+    def get(self, snapshot_ts, relative_path):
+        """
+        Returns the FileMetadata for relative_path (a list of path
+        components) at the given snapshot, or None if it isn't known.
+        """
+        (directory, _, name) = \
+            ("/".join(relative_path) or ".").rpartition("/")
+        metadata = self.get_directory(snapshot_ts, directory)
+        if metadata is None:
+            return None
+        return metadata.records.get(name)
+
+# The virtual directory listing the changes between snapshots. Snapshot
+# timestamps never start with a dot, so it can't collide with one.
+CHANGES_DIR = ".changes"
+
+# The virtual file containing the filesystem's statistics, in JSON.
+STATS_FILE = ".stats"
+
+# The kinds of change reported by RdiffSnapshotFs.iter_changes.
+CHANGE_ADDED = "added"
+CHANGE_REMOVED = "removed"
+CHANGE_MODIFIED = "modified"
+CHANGE_TYPES = (CHANGE_ADDED, CHANGE_REMOVED, CHANGE_MODIFIED)
+
+def parse_bool_option(value):
+    "Interprets the value of a boolean command line option."
+    if isinstance(value, basestring):
+        return value.lower() in ("1", "yes", "true", "on")
+    return bool(value)
+
+# Materialized files are named after the SHA-1 of the increment path that
+# identifies their content.
+MATERIALIZED_FILE_PATTERN = re.compile(r"^[0-9a-f]{40}$")
+MATERIALIZED_TEMP_SUFFIX = ".tmp"
+
+class Reconstruction():
+    """
+    Tracks a file that is being reconstructed in the background into
+    temp_path, so that reads can be served from the part that has already
+    been written.
+    """
+    def __init__(self, temp_path):
+        self.temp_path = temp_path
+        self.condition = threading.Condition()
+        self.produced = 0
+        self.finished = False
+        self.exc_info = None
+    def advance_to(self, position):
+        "Records that the first position bytes have been written."
+        with self.condition:
+            if position > self.produced:
+                self.produced = position
+                self.condition.notify_all()
+    def finish(self, exc_info = None):
+        "Records that the reconstruction is done (or failed with exc_info)."
+        with self.condition:
+            self.finished = True
+            self.exc_info = exc_info
+            self.condition.notify_all()
+    def wait_for(self, end = None):
+        """
+        Waits until the first end bytes (or, if end is None, all of the file)
+        have been written. Raises the reconstruction's exception if it failed
+        before then.
+        """
+        with self.condition:
+            while not self.finished and (end is None or self.produced < end):
+                self.condition.wait()
+            if self.exc_info is not None \
+                    and (end is None or self.produced < end):
+                raise self.exc_info[0], self.exc_info[1], self.exc_info[2]
+
+class MaterializationCache():
+    """
+    A size-bounded, process-wide cache of reconstructed historical files.
+
+    Files are stored in cache_dir, keyed by the path of the increment file that
+    identifies their content. Since increments never change once written,
+    cached files stay valid for as long as the increment exists, and can
+    optionally be kept across remounts (if persistent is set). When the total
+    size exceeds max_bytes, the least recently used files are removed.
+
+    Concurrent requests for the same file share a single reconstruction.
+    Reconstructions run in the background on workers (a WorkerPool), if
+    given, and can be read while they are in progress.
+
+    If checkpoint_interval is set, every checkpoint_interval-th intermediate
+    version produced while applying a chain of diffs is kept in a separate
+    store of checkpoint_bytes. Later reconstructions start from the nearest
+    cached or checkpointed version rather than from the head of the chain.
+
+    If given, stats (a Stats) records the time taken by reconstructions and
+    the amount of data they produce.
+
+    If namespace_of is given, it maps keys to namespaces (see CacheShares),
+    and eviction is fair between namespaces instead of strictly LRU.
+    """
+    def __init__(self, cache_dir, max_bytes, persistent, workers = None,
+                 checkpoint_bytes = 0, checkpoint_interval = 0, stats = None,
+                 namespace_of = None):
+        self.max_bytes = max_bytes
+        self.workers = workers
+        self.stats_collector = stats
+        self.namespace_of = namespace_of
+        self.shares = None
+        if namespace_of is not None:
+            self.shares = CacheShares()
+        self.checkpoint_interval = checkpoint_interval
+        self.lock = threading.Lock()
+        # Maps key -> Reconstruction for files being reconstructed.
+        self.in_progress = {}
+        self.persistent = persistent and cache_dir is not None
+        # If no directory was given, use a private temporary directory that is
+        # removed when the cache is closed.
+        self.owns_cache_dir = cache_dir is None
+        if cache_dir is None:
+            cache_dir = tempfile.mkdtemp(prefix = "rdiff-snapshot-fs-")
+        elif not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir, 0700)
+        self.cache_dir = cache_dir
+        # Maps key -> (filename, size). Least recently used entries come first.
+        self.entries = collections.OrderedDict()
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        # Reconstructions that started from an intermediate version in this
+        # cache.
+        self.intermediate_hits = 0
+        self.evictions = 0
+        self._scan()
+        self.checkpoints = None
+        if checkpoint_interval > 0:
+            self.checkpoints = MaterializationCache(
+                os.path.join(cache_dir, "checkpoints"), checkpoint_bytes,
+                self.persistent, namespace_of = namespace_of)
+    def _scan(self):
+        """
+        Cleans up the cache directory at startup. Files left over from a
+        previous mount are adopted if the cache is persistent, and removed
+        otherwise.
+        """
+        existing = []
+        for filename in os.listdir(self.cache_dir):
+            path = os.path.join(self.cache_dir, filename)
+            if filename.endswith(MATERIALIZED_TEMP_SUFFIX) \
+                    or (MATERIALIZED_FILE_PATTERN.match(filename)
+                        and not self.persistent):
+                os.unlink(path)
+            elif MATERIALIZED_FILE_PATTERN.match(filename):
+                statresult = os.stat(path)
+                existing.append(
+                    (statresult.st_mtime, filename, statresult.st_size))
+        # We don't know the original keys, but lookups only need the hashed
+        # filename anyway.
+        for (_, filename, size) in sorted(existing):
+            self._add(None, filename, size)
+        self._evict()
+    def _path(self, filename):
+        return os.path.join(self.cache_dir, filename)
+    def _add(self, key, filename, size):
+        "Records the file for key (None if unknown) as cached."
+        self.entries[filename] = (filename, size)
+        self.total_bytes += size
+        if self.shares is not None:
+            # Files adopted from a previous mount have no known namespace.
+            namespace = None
+            if key is not None:
+                namespace = self.namespace_of(key)
+            self.shares.add(filename, namespace, size)
+    def _evict(self, keep = None):
+        "Removes least recently used files until we're within budget."
+        while self.total_bytes > self.max_bytes:
+            if self.shares is None:
+                filename = next((filename for filename in self.entries
+                                 if filename != keep), None)
+            else:
+                filename = self.shares.choose_victim(keep)
+            if filename is None:
+                break
+            (_, size) = self.entries.pop(filename)
+            self.total_bytes -= size
+            if self.shares is not None:
+                self.shares.remove(filename)
+            self.evictions += 1
+            try:
+                os.unlink(self._path(filename))
+            except OSError:
+                pass
+    def get(self, key):
+        """
+        Returns the path of the materialized file for key, or None if it isn't
+        in the cache. The lookup isn't counted; see count_lookup.
+        """
+        filename = hashlib.sha1(key).hexdigest()
+        with self.lock:
+            try:
+                entry = self.entries.pop(filename)
+            except KeyError:
+                return None
+            self.entries[filename] = entry
+            if self.shares is not None:
+                self.shares.touch(filename)
+            return self._path(filename)
+    def count_lookup(self, hit):
+        "Counts a hit (or miss) for a lookup done with get."
+        with self.lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+    def open(self, key, backing_file, diffs, inline = False):
+        """
+        Opens the materialized file for key, starting to reconstruct it from
+        backing_file and diffs if it isn't already cached. Returns a file
+        descriptor and, if the file is still being reconstructed, its
+        Reconstruction. If inline is set, any reconstruction is done by the
+        calling thread before returning.
+        """
+        filename = hashlib.sha1(key).hexdigest()
+        with self.lock:
+            # Files are only removed or renamed with the lock held, so the
+            # opens can't race with eviction.
+            if filename in self.entries:
+                self.entries[filename] = self.entries.pop(filename)
+                if self.shares is not None:
+                    self.shares.touch(filename)
+                self.hits += 1
+                return (os.open(self._path(filename), os.O_RDONLY), None)
+            reconstruction = self.in_progress.get(key)
+            if reconstruction is not None:
+                return (os.open(reconstruction.temp_path, os.O_RDONLY),
+                        reconstruction)
+            self.misses += 1
+            (fd, temp_path) = tempfile.mkstemp(
+                suffix = MATERIALIZED_TEMP_SUFFIX, dir = self.cache_dir)
+            reconstruction = Reconstruction(temp_path)
+            self.in_progress[key] = reconstruction
+        if self.workers is not None and not inline:
+            self.workers.submit(self._reconstruct, key, backing_file, diffs,
+                                reconstruction)
+        else:
+            self._reconstruct(key, backing_file, diffs, reconstruction)
+        return (fd, reconstruction)
+    def _reconstruct(self, key, backing_file, diffs, reconstruction):
+        "Reconstructs a file started by open, then adds it to the cache."
+        temp_path = reconstruction.temp_path
+        filename = hashlib.sha1(key).hexdigest()
+        start = time.time()
+        try:
+            (start_file, remaining_diffs) = \
+                self._find_checkpoint(backing_file, diffs)
+            try:
+                self._restore(start_file, remaining_diffs,
+                              len(diffs) - len(remaining_diffs), temp_path,
+                              reconstruction)
+            except EnvironmentError as e:
+                # The checkpoint may have been evicted before we opened it.
+                if start_file == backing_file or e.errno != errno.ENOENT:
+                    raise
+                self._restore(backing_file, diffs, 0, temp_path,
+                              reconstruction)
+            size = os.stat(temp_path).st_size
+            if self.stats_collector is not None:
+                self.stats_collector.record("reconstruct", time.time() - start)
+                self.stats_collector.count("bytes_reconstructed", size)
+            with self.lock:
+                os.rename(temp_path, self._path(filename))
+                del self.in_progress[key]
+                self._add(key, filename, size)
+                self._evict(keep = filename)
+        except:
+            exc_info = sys.exc_info()
+            with self.lock:
+                del self.in_progress[key]
+                os.unlink(temp_path)
+            reconstruction.finish(exc_info)
+            return
+        reconstruction.finish()
+    def _find_checkpoint(self, backing_file, diffs):
+        """
+        Returns the file to start reconstructing from and the diffs that
+        remain to be applied to it, using the latest intermediate version in
+        the chain that is available in this cache or the checkpoint store.
+
+        Each search counts once: as an intermediate hit here, or as a hit or
+        miss in the checkpoint store.
+        """
+        if len(diffs) < 2:
+            return (backing_file, diffs)
+        for i in xrange(len(diffs) - 2, -1, -1):
+            path = self.get(diffs[i])
+            if path is not None:
+                with self.lock:
+                    self.intermediate_hits += 1
+                return (path, diffs[i + 1:])
+            if self.checkpoints is not None:
+                path = self.checkpoints.get(diffs[i])
+                if path is not None:
+                    self.checkpoints.count_lookup(True)
+                    return (path, diffs[i + 1:])
+        if self.checkpoints is not None:
+            self.checkpoints.count_lookup(False)
+        return (backing_file, diffs)
+    def _restore(self, start_file, diffs, position, dest_file,
+                 reconstruction):
+        """
+        Runs restore_file, keeping checkpoints of intermediate versions.
+        position is the number of diffs already applied to start_file.
+        """
+        def keep_intermediate(i, intermediate_file):
+            if self.checkpoints is None \
+                    or (position + i + 1) % self.checkpoint_interval != 0:
+                return False
+            return self.checkpoints.adopt(diffs[i], intermediate_file)
+        restore_file(start_file, diffs, dest_file, keep_intermediate,
+                     reconstruction)
+    def adopt(self, key, source_path):
+        """
+        Moves the file source_path into the cache under key. Returns False
+        (leaving the file alone) if it can't be added.
+        """
+        filename = hashlib.sha1(key).hexdigest()
+        path = self._path(filename)
+        size = os.stat(source_path).st_size
+        with self.lock:
+            if filename in self.entries or size > self.max_bytes:
+                return False
+            try:
+                os.rename(source_path, path)
+            except OSError:
+                return False
+            self._add(key, filename, size)
+            self._evict(keep = filename)
+        return True
+    def close(self):
+        "Removes the cached files, unless the cache is persistent."
+        if self.checkpoints is not None:
+            self.checkpoints.close()
+        if self.persistent:
+            return
+        with self.lock:
+            for filename in self.entries:
+                try:
+                    os.unlink(self._path(filename))
+                except OSError:
+                    pass
+            self.entries.clear()
+            self.total_bytes = 0
+            if self.shares is not None:
+                self.shares.clear()
+        if self.owns_cache_dir:
+            shutil.rmtree(self.cache_dir, ignore_errors = True)
+    def stats(self):
+        "Returns a dict of counters describing the cache."
+        with self.lock:
+            stats = {
+                "entries": len(self.entries),
+                "bytes": self.total_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "intermediate_hits": self.intermediate_hits,
+                "evictions": self.evictions,
+                }
+        if self.checkpoints is not None:
+            stats["checkpoints"] = self.checkpoints.stats()
+        return stats
+
 class RdiffSnapshotFs(fuse.Fuse):
     """
     Filesystem that provides a read-only view of snapshots in a repository
     created by rdiff-backup.
     """
+    # Defaults for the options that can be set with -o on the command line.
+    cache_entries = 256
+    cache_bytes = 64 * 1024 * 1024
+    negative_cache_entries = 4096
+    materialize_dir = None
+    materialize_bytes = 1024 * 1024 * 1024
+    materialize_persist = False
+    checkpoint_interval = 8
+    checkpoint_bytes = 256 * 1024 * 1024
+    gzip_index_entries = 64
+    gzip_index_span = 8 * 1024 * 1024
+    gzip_index_bytes = 64 * 1024 * 1024
+    snapshot_check_interval = 5
+    increment_index = None
+    metadata = True
+    reconstruction_workers = 4
+    direct_io = False
+    keep_cache = False
+    prefetch = False
+    prefetch_workers = 2
+    prefetch_max_file_size = 1024 * 1024
+    prefetch_bytes = 64 * 1024 * 1024
+    stats_log = None
+    stats_interval = 60
+    # Functions mapping the keys of the directory and materialization caches
+    # to namespaces between which eviction is fair; None for plain LRU.
+    dir_cache_namespace = None
+    file_cache_namespace = None
+
     def __init__(self, repository_path, *args, **kw):
+        # If given, the MultiRepositoryFs whose resources this repository
+        # uses.
+        self.shared = kw.pop("shared", None)
         fuse.Fuse.__init__(self, *args, **kw)
         self.repository_path = repository_path
         self.increments_path = os.path.join(
             repository_path, "rdiff-backup-data", "increments")
+        self.data_path = os.path.join(repository_path, "rdiff-backup-data")
         self.snapshot_list = None
+        self.snapshot_times = None
+        self.snapshot_set = None
+        self.snapshot_dir_mtime = None
+        self.snapshot_check_time = None
+        self.snapshot_lock = threading.Lock()
+        self.deferred_dir_builds = SingleFlight()
+        self.stats = Stats()
+        self.stats_log_stop = None
+        self.configure()
+
+    def configure(self):
+        """
+        (Re)creates internal data structures from the current option values.
+        Must be called again after the command line has been parsed.
+        """
+        if self.shared is not None:
+            self.configure_shared()
+            return
+        self.deferred_dir_cache = DeferredDirCache(
+            int(self.cache_entries), int(self.cache_bytes),
+            int(self.negative_cache_entries), self.dir_cache_namespace)
+        if getattr(self, "materialization_cache", None) is not None:
+            self.close()
+        self.workers = WorkerPool(int(self.reconstruction_workers))
+        self.materialization_cache = MaterializationCache(
+            self.materialize_dir, int(self.materialize_bytes),
+            parse_bool_option(self.materialize_persist), self.workers,
+            int(self.checkpoint_bytes), int(self.checkpoint_interval),
+            self.stats, self.file_cache_namespace)
+        self.gzip_index_cache = GzipIndexCache(
+            int(self.gzip_index_entries), int(self.gzip_index_span),
+            int(self.gzip_index_bytes))
+        self.prefetcher = None
+        if parse_bool_option(self.prefetch):
+            # Only the jobs for the last few directories listed are worth
+            # doing.
+            self.prefetcher = Prefetcher(int(self.prefetch_workers), 4096, 4)
+        self.configure_repository()
 
-        self.last_requested_snapshot_ts = None
-        self.last_relative_path = None
+    def configure_repository(self):
+        """
+        (Re)creates the data structures that describe this repository alone,
+        as opposed to the caches and workers.
+        """
+        self.mirror_metadata = None
+        if parse_bool_option(self.metadata):
+            # The metadata index is kept next to the increment index, if
+            # there is one.
+            metadata_index = None
+            if self.increment_index:
+                metadata_index = self.increment_index + "-metadata"
+            self.mirror_metadata = MirrorMetadata(
+                self.data_path, metadata_index, self.deferred_dir_cache,
+                self.gzip_index_cache)
+        self.increment_db = None
+        if self.increment_index:
+            self.increment_db = IncrementIndex(
+                self.increments_path, self.increment_index)
+            self.increment_db.update()
+
+    def configure_shared(self):
+        """
+        Configures this repository to use the options, caches, workers and
+        statistics of self.shared.
+        """
+        if getattr(self, "increment_db", None) is not None:
+            self.increment_db.close()
+        if getattr(self, "mirror_metadata", None) is not None:
+            self.mirror_metadata.close()
+        shared = self.shared
+        for name in shared.REPOSITORY_OPTIONS:
+            setattr(self, name, getattr(shared, name))
+        self.deferred_dir_cache = CacheNamespace(shared.deferred_dir_cache,
+                                                 self.repository_path)
+        self.workers = shared.workers
+        self.materialization_cache = shared.materialization_cache
+        self.gzip_index_cache = shared.gzip_index_cache
+        self.prefetcher = shared.prefetcher
+        self.stats = shared.stats
+        # With several repositories, increment_index names a directory with
+        # an index for each.
+        self.increment_index = None
+        if shared.increment_index:
+            self.increment_index = os.path.join(
+                shared.increment_index,
+                os.path.basename(self.repository_path) + ".sqlite")
+        self.configure_repository()
+
+    def fsinit(self):
+        """
+        Called by fuse-python once the filesystem is mounted, in the process
+        that serves it (which, unless -f or -d is given, is not the one that
+        configured it). Starts the threads that run independently of
+        requests; the others are started on demand.
+        """
+        if self.stats_log and self.stats_log_stop is None:
+            self.stats_log_stop = threading.Event()
+            self.stats_log_thread = threading.Thread(
+                target = self._log_stats, args = (self.stats_log_stop,))
+            self.stats_log_thread.daemon = True
+            self.stats_log_thread.start()
+
+    def close(self):
+        "Releases resources held by the filesystem, e.g. at unmount."
+        if self.increment_db is not None:
+            self.increment_db.close()
+        if self.mirror_metadata is not None:
+            self.mirror_metadata.close()
+        if self.shared is not None:
+            # Everything else belongs to self.shared.
+            return
+        if self.stats_log_stop is not None:
+            self.stats_log_stop.set()
+            self.stats_log_thread.join()
+            self.stats_log_stop = None
+        if self.prefetcher is not None:
+            self.prefetcher.close()
+        # Let running reconstructions finish before removing their files.
+        self.workers.close()
+        self.materialization_cache.close()
+
+    def get_stats(self):
+        """
+        Returns the statistics shown in /.stats: latencies and counters, and
+        the state of each cache.
+        """
+        stats = self.stats.to_dict()
+        caches = {
+            "deferred_dirs": self.deferred_dir_cache.stats(),
+            "materialized_files": self.materialization_cache.stats(),
+            "gzip_indexes": self.gzip_index_cache.stats(),
+            }
+        for cache_stats in caches.values():
+            lookups = cache_stats["hits"] + cache_stats["misses"]
+            cache_stats["hit_ratio"] = \
+                float(cache_stats["hits"]) / lookups if lookups else None
+        if self.prefetcher is not None:
+            caches["prefetcher"] = self.prefetcher.stats()
+        stats["caches"] = caches
+        return stats
+
+    def _log_stats(self, stop):
+        "Appends the statistics to stats_log every stats_interval seconds."
+        while not stop.wait(float(self.stats_interval)):
+            with open(self.stats_log, "a") as log:
+                log.write(json.dumps(self.get_stats(), sort_keys = True))
+                log.write("\n")
 
     def compute_snapshots(self):
         """
-        Yields a sequence of available snapshots.
+        Yields a sequence of (time, timestamp) pairs for the available
+        snapshots, in chronological order, where time is in seconds since the
+        epoch.
         """
-        output_lines = invoke_command("/usr/bin/rdiff-backup", "-l",
-                                      self.repository_path)
-        for line in output_lines:
-            match = INCREMENTS_PATTERN.match(line.rstrip())
-            if match:
-                snapshot_ts = match.group(1)
-                yield snapshot_ts
+        snapshots = []
+        mirror_snapshots = []
+        for filename in os.listdir(self.data_path):
+            match = SNAPSHOT_MARKER_PATTERN.match(filename)
+            if not match:
+                continue
+            (marker_type, snapshot_ts, suffix) = match.groups()
+            try:
+                snapshot_time = parse_timestamp(snapshot_ts)
+            except ValueError:
+                continue
+            if marker_type == "increments" and suffix == "dir":
+                snapshots.append((snapshot_time, snapshot_ts))
+            elif marker_type == "current_mirror" and suffix == "data":
+                mirror_snapshots.append((snapshot_time, snapshot_ts))
+        # If a backup is in progress (or was interrupted), there are two
+        # current_mirror markers, and the mirror is only consistent with the
+        # older one. The session that wrote the newer marker may already have
+        # created an increments marker for the older one, which we have then
+        # already listed.
+        if mirror_snapshots and min(mirror_snapshots) not in snapshots:
+            snapshots.append(min(mirror_snapshots))
+        snapshots.sort()
+        for snapshot in snapshots:
+            yield snapshot
 
     def get_snapshots(self):
         """
         Return a list of all available snapshots, in chronological order.
-        Caches the result.
+        Caches the result, and refreshes it when the repository has been
+        modified (checking at most every snapshot_check_interval seconds).
         """
-        # TODO: invalidate cache when the repository directory has been
-        # modified.
-        if self.snapshot_list is None:
-            self.snapshot_list = list(self.compute_snapshots())
+        with self.snapshot_lock:
+            return self._get_snapshots()
+
+    def _get_snapshots(self):
+        now = time.time()
+        if self.snapshot_list is not None and now < \
+                self.snapshot_check_time + float(self.snapshot_check_interval):
+            return self.snapshot_list
+        self.snapshot_check_time = now
+        # Every backup session adds or renames marker files, which updates
+        # the mtime of rdiff-backup-data.
+        dir_mtime = os.stat(self.data_path).st_mtime
+        if self.snapshot_list is None or dir_mtime != self.snapshot_dir_mtime:
+            with self.stats.timer("compute_snapshots"):
+                snapshots = list(self.compute_snapshots())
+            if self.snapshot_list is not None \
+                    and [ts for (_, ts) in snapshots] != self.snapshot_list:
+                # The mirror has changed, so cached deferred directories that
+                # point into it are stale.
+                self.deferred_dir_cache.clear()
+                if self.mirror_metadata is not None:
+                    self.mirror_metadata.invalidate()
+                if self.increment_db is not None:
+                    self.increment_db.update()
+            self.snapshot_dir_mtime = dir_mtime
+            self.snapshot_times = [t for (t, _) in snapshots]
+            self.snapshot_list = [ts for (_, ts) in snapshots]
+            self.snapshot_set = frozenset(self.snapshot_list)
         return self.snapshot_list
 
+    def is_snapshot(self, snapshot_ts):
+        "Returns True if snapshot_ts names an available snapshot."
+        self.get_snapshots()
+        return snapshot_ts in self.snapshot_set
+
     def get_deferred_dir(self, requested_snapshot_ts, relative_path):
         """
         Returns a 'deferred directory', which is a data structure that contains
         all the information needed to reconstruct a historical snapshot, but
         doesn't actually do any of the work needed to do so until asked to.
+        It is a dict mapping basenames to DeferredFile objects.
         """
-        # Memoizing wrapper around build_deferred_dir.
-        #
-        # TODO: to improve performance we could cache more than one deferred
-        # directory.
-        if requested_snapshot_ts != self.last_requested_snapshot_ts \
-                or relative_path != self.last_relative_path:
-            self.last_requested_snapshot_ts = requested_snapshot_ts
-            self.last_relative_path = relative_path
-            self.last_deferred_dir = self.build_deferred_dir(
-                requested_snapshot_ts, relative_path)
-        return self.last_deferred_dir
+        return self.get_directory_timeline(relative_path).get_files(
+            parse_timestamp(requested_snapshot_ts))
 
-    def build_deferred_dir(self, requested_snapshot_ts, relative_path):
+    def get_directory_timeline(self, relative_path):
         """
-        Returns a deferred directory, which is a dict mapping basenames to
-        DeferredFile objects.
+        Returns the (cached) DirectoryTimeline for relative_path. Raises
+        OSError with ENOENT if the directory never existed.
+        """
+        key = tuple(relative_path)
+        timeline = self.deferred_dir_cache.get(key)
+        if timeline is None:
+            if self.deferred_dir_cache.is_negative(key):
+                raise OSError(errno.ENOENT, os.strerror(errno.ENOENT))
+            # A listing usually triggers a burst of concurrent lookups in the
+            # same directory; build it only once.
+            timeline = self.deferred_dir_builds.do(
+                key, self._build_and_cache_directory_timeline, key,
+                relative_path)
+        return timeline
+
+    def _build_and_cache_directory_timeline(self, key, relative_path):
+        try:
+            timeline = self.build_directory_timeline(relative_path)
+        except OSError as e:
+            if e.errno == errno.ENOENT:
+                self.deferred_dir_cache.put_negative(key)
+            raise
+        self.deferred_dir_cache.put(key, timeline)
+        return timeline
+
+    def get_deferred_file(self, requested_snapshot_ts, relative_path):
+        """
+        Returns the DeferredFile for relative_path (a list of path components)
+        at the requested snapshot. Raises OSError with ENOENT if the file
+        didn't exist at that time.
+        """
+        key = (requested_snapshot_ts, tuple(relative_path))
+        if self.deferred_dir_cache.is_negative(key):
+            raise OSError(errno.ENOENT, os.strerror(errno.ENOENT))
+        timeline = self.get_directory_timeline(relative_path[:-1])
+        entry = timeline.get_file(
+            parse_timestamp(requested_snapshot_ts), relative_path[-1])
+        if entry is None or entry.file_type == NONEXISTENT:
+            self.deferred_dir_cache.put_negative(key)
+            raise OSError(errno.ENOENT, os.strerror(errno.ENOENT))
+        return entry
+
+    def prefetch_directory(self, snapshot_ts, relative_path):
+        """
+        Schedules warming of the caches for the contents of a historical
+        directory that has just been listed: the metadata of its files,
+        the timelines of its subdirectories and the data of its small files.
+        """
+        batch = self.prefetcher.new_batch()
+        self.prefetcher.submit(batch, self._prefetch_directory, batch,
+                               snapshot_ts, relative_path)
+
+    def _prefetch_directory(self, batch, snapshot_ts, relative_path):
+        file_info = self.get_deferred_dir(snapshot_ts, relative_path)
+        if self.mirror_metadata is not None:
+            self.mirror_metadata.get_directory(snapshot_ts,
+                                               "/".join(relative_path))
+        budget = int(self.prefetch_bytes)
+        for name in sorted(file_info):
+            entry = file_info[name]
+            path = relative_path + [name]
+            if entry.file_type == DIRECTORY:
+                self.prefetcher.submit(batch, self.get_directory_timeline, path)
+            elif entry.file_type == REGULAR_FILE \
+                    and entry.needs_reconstruction():
+                file_metadata = None
+                if self.mirror_metadata is not None:
+                    file_metadata = self.mirror_metadata.get(snapshot_ts, path)
+                if file_metadata is not None:
+                    size = file_metadata.size
+                else:
+                    size = os.lstat(entry.backing_file).st_size
+                if size <= int(self.prefetch_max_file_size) \
+                        and size <= budget:
+                    budget -= size
+                    self.prefetcher.submit(batch, self._prefetch_file, entry)
+
+    def _prefetch_file(self, entry):
+        (fd, _) = self.materialization_cache.open(
+            entry.source_increment(), entry.backing_file, entry.diffs,
+            inline = True)
+        os.close(fd)
+
+    def list_increments(self, relative_path):
+        """
+        Returns the increment records (see scan_increment_dir) for a directory
+        of the increments/ tree, or None if there is no such directory.
+        """
+        if self.increment_db is not None:
+            return self.increment_db.list_dir(relative_path)
+        try:
+            return scan_increment_dir(
+                os.path.join(self.increments_path, *relative_path))[0]
+        except OSError:
+            return None
+
+    def scan_increments(self, relative_path):
+        """
+        Like list_increments, but returns a pair of the increment records and
+        the names of the subdirectories, or None if there is no such
+        directory.
+        """
+        if self.increment_db is not None:
+            records = self.increment_db.list_dir(relative_path)
+            if records is None:
+                return None
+            return (records, self.increment_db.list_subdirs(relative_path))
+        try:
+            return scan_increment_dir(
+                os.path.join(self.increments_path, *relative_path))
+        except OSError:
+            return None
+
+    def iter_changes(self, from_ts, to_ts, relative_path = []):
+        """
+        Yields (change type, relative path, is directory) triples describing
+        how the tree under relative_path changed between two snapshots (from_ts
+        being the older one), where the change type is one of CHANGE_TYPES.
+        Paths are yielded in sorted order as they are found.
+
+        This only looks at the increments/ tree: a file changed between the
+        snapshots iff it has an increment stamped at or after from_ts and
+        before to_ts. Only directories that were added or removed are
+        reported, not the contents of such directories.
+        """
+        from_time = parse_timestamp(from_ts)
+        to_time = parse_timestamp(to_ts)
+        pending = [list(relative_path)]
+        while pending:
+            path = pending.pop()
+            scan = self.scan_increments(path)
+            if scan is None:
+                continue
+            (records, subdirs) = scan
+            # The increments made at or after the older snapshot, by name.
+            increments = {}
+            for (_, basename, timestamp, objtype, _, _) in records:
+                increment_time = parse_timestamp(timestamp)
+                if increment_time >= from_time:
+                    increments.setdefault(basename, []).append(
+                        (increment_time, objtype))
+            skip = set()
+            for name in sorted(increments):
+                changes = sorted(increments[name])
+                if changes[0][0] >= to_time:
+                    continue
+                # The state at each snapshot is given by the first increment
+                # made at or after it, or for the newer snapshot, possibly by
+                # the mirror.
+                before = changes[0][1]
+                after = [objtype for (increment_time, objtype) in changes
+                         if increment_time >= to_time]
+                existed_before = before != "missing"
+                was_dir = before == "dir"
+                if after:
+                    exists_after = after[0] != "missing"
+                    is_dir = after[0] == "dir"
+                else:
+                    mirror_path = os.path.join(
+                        self.repository_path, *(path + [name]))
+                    exists_after = os.path.lexists(mirror_path)
+                    is_dir = exists_after and os.path.isdir(mirror_path) \
+                        and not os.path.islink(mirror_path)
+                if not existed_before and exists_after:
+                    skip.add(name)
+                    yield (CHANGE_ADDED, path + [name], is_dir)
+                elif existed_before and not exists_after:
+                    skip.add(name)
+                    yield (CHANGE_REMOVED, path + [name], was_dir)
+                elif existed_before and exists_after:
+                    if was_dir != is_dir:
+                        skip.add(name)
+                        yield (CHANGE_MODIFIED, path + [name], is_dir)
+                    elif not is_dir:
+                        yield (CHANGE_MODIFIED, path + [name], False)
+            for name in sorted(subdirs, reverse = True):
+                if name not in skip:
+                    pending.append(path + [name])
+
+    @timed("build_directory_timeline")
+    def build_directory_timeline(self, relative_path):
+        """
+        Scans a directory in the mirror and the increments/ tree, returning a
+        DirectoryTimeline.
         """
         # To build a deferred directory, we need to dig around in the diffs to
         # figure out what files existed at the time this snapshot was taken.
+        mirror_dir = os.path.join(self.repository_path, *relative_path)
         try:
-            files = os.listdir(
-                os.path.join(self.repository_path, *relative_path))
+            files = os.listdir(mirror_dir)
         except OSError:
             # Directory doesn't exist in current snapshot, i.e. it was deleted
             # since the requested snapshot was written. For diffing purposes
             # start with an empty base.
-            files = []
+            files = None
         increment_dir = os.path.join(self.increments_path, *relative_path)
-        try:
-            increment_files = os.listdir(increment_dir)
-        except OSError:
-            # No corresponding directory exists in the increments/ directory.
-            # That means no reverse diffs were recorded.
-            increment_files = []
+        # If no corresponding directory exists in the increments/ directory,
+        # no reverse diffs were recorded.
+        increment_records = self.list_increments(relative_path)
+        if files is None and increment_records is None:
+            # The directory never existed.
+            raise OSError(errno.ENOENT, os.strerror(errno.ENOENT))
 
-        file_info = {}
+        # The files in the current snapshot of the directory aren't examined
+        # until they're asked for.
+        mirror_names = [filename for filename in files or []
+                        if filename != "rdiff-backup-data"]
+        return DirectoryTimeline(mirror_dir, mirror_names, increment_dir,
+                                 increment_records or [])
 
-        # List all the files in the current snapshot of the directory.
-        for filename in files:
-            if filename == "rdiff-backup-data":
-                continue
-            backing_file_path = os.path.join(
-                os.path.join(self.repository_path, *relative_path),
-                filename)
-            file_info[filename] = \
-                DeferredFile(filename, backing_file_path,
-                             get_file_type(os.lstat(backing_file_path).st_mode))
-
-        # Identify all the diffs that are relevant to this snapshot. This means
-        # all diffs with timestamps between this snapshot and the present time.
-        diff_info = {}
-        for increment_file in increment_files:
-            try:
-                file_mode = os.lstat(
-                    os.path.join(increment_dir, increment_file)).st_mode
-                if stat.S_ISREG(file_mode):
-                    (basename, timestamp, objtype) = \
-                        parse_increment_filename(increment_file)
-                    # TODO: do a proper comparison with dates. Dates sort
-                    # lexicographically, but only approximately...
-                    if timestamp >= requested_snapshot_ts:
-                        if basename not in diff_info:
-                            diff_info[basename] = []
-                        diff_info[basename].append(
-                            (timestamp, objtype, increment_file))
-            except OSError:
-                pass
+    def get_export_attributes(self, snapshot_ts, relative_path, entry):
+        """
+        Returns the FileMetadata to give to the exported copy of entry,
+        which is relative_path at the given snapshot. The uid and gid are
+        None if they aren't known.
+        """
+        if self.mirror_metadata is not None:
+            file_metadata = self.mirror_metadata.get(snapshot_ts, relative_path)
+            if file_metadata is not None:
+                return file_metadata
+        if snapshot_ts == self.get_snapshots()[-1]:
+            statresult = os.lstat(
+                os.path.join(self.repository_path, *relative_path))
+            (uid, gid) = (statresult.st_uid, statresult.st_gid)
+        elif entry.file_type == DIRECTORY:
+            return FileMetadata(
+                mode = stat.S_IFDIR | 0755, size = 4096,
+                mtime = parse_timestamp(snapshot_ts), uid = None, gid = None,
+                inode = 0, nlink = 2)
+        else:
+            # As in getattr, this is only an approximation.
+            statresult = os.lstat(entry.backing_file)
+            (uid, gid) = (None, None)
+        return FileMetadata(
+            mode = statresult.st_mode, size = statresult.st_size,
+            mtime = statresult.st_mtime, uid = uid, gid = gid,
+            inode = statresult.st_ino,
+            nlink = statresult.st_nlink)
 
-        for basename in diff_info:
-            # For each file, process the diffs in reverse chronological order
-            # to reconstruct the original directory listing.
-            diff_info[basename].sort(
-                key = lambda change_info : change_info[0],
-                reverse = True)
-            for (timestamp, change_type, increment_file) in diff_info[basename]:
-                # Create a fake basefile we can apply diffs against.
-                if basename not in file_info:
-                    file_info[basename] = DeferredFile(basename, None, NONEXISTENT)
-                file_info[basename].apply(
-                    change_type,
-                    os.path.join(increment_dir, increment_file))
+    def plan_export(self, snapshot_ts, relative_path):
+        """
+        Returns a list of (relative path, DeferredFile, FileMetadata) triples
+        for relative_path and everything below it at the given snapshot, with
+        each directory ahead of its contents. Raises OSError with ENOENT if
+        relative_path didn't exist at that time.
+        """
+        if relative_path:
+            entry = self.get_deferred_file(snapshot_ts, relative_path)
+        else:
+            entry = DeferredFile("", self.repository_path, DIRECTORY)
+        plan = []
+        pending = [(relative_path, entry)]
+        while pending:
+            (path, entry) = pending.pop()
+            plan.append(
+                (path, entry,
+                 self.get_export_attributes(snapshot_ts, path, entry)))
+            if entry.file_type == DIRECTORY:
+                file_info = self.get_deferred_dir(snapshot_ts, path)
+                for name in sorted(file_info, reverse = True):
+                    if file_info[name].file_type != NONEXISTENT:
+                        pending.append((path + [name], file_info[name]))
+        return plan
 
-        return file_info
+    def parse_change_range(self, name):
+        """
+        Parses the name of a directory under /.changes, "<from>..<to>",
+        returning the two snapshot timestamps, or None if the name isn't two
+        snapshots in chronological order.
+        """
+        (from_ts, separator, to_ts) = name.partition("..")
+        if not separator or not self.is_snapshot(from_ts) \
+                or not self.is_snapshot(to_ts) \
+                or parse_timestamp(from_ts) >= parse_timestamp(to_ts):
+            return None
+        return (from_ts, to_ts)
+
+    def generate_change_list(self, from_ts, to_ts, change_type):
+        """
+        Yields the lines of a change list: the paths of one type of change,
+        with a slash after directories.
+        """
+        for (change, path, is_dir) in self.iter_changes(from_ts, to_ts):
+            if change == change_type:
+                yield "/".join(path) + ("/\n" if is_dir else "\n")
+
+    def getattr_changes(self, components):
+        """
+        Returns the attributes of a path under /.changes, given its
+        components.
+        """
+        snapshots = self.get_snapshots()
+        ino = get_inode(CHANGES_DIR, components[1:])
+        if len(components) == 1:
+            mtime = self.snapshot_times[-1] if snapshots else 0
+            return SnapshotFsStat(mtime, stat.S_IFDIR | 0555, ino = ino)
+        change_range = self.parse_change_range(components[1])
+        if change_range is None or len(components) > 3 \
+                or components[2:] and components[2] not in CHANGE_TYPES:
+            return -errno.ENOENT
+        mtime = parse_timestamp(change_range[1])
+        if len(components) == 2:
+            return SnapshotFsStat(mtime, stat.S_IFDIR | 0555, ino = ino)
+        # The length isn't known until the list has been generated.
+        return SnapshotFsStat(mtime, stat.S_IFREG | 0444, size = 0, ino = ino)
+
+    def readdir_changes(self, components):
+        """
+        Lists a directory under /.changes, given its components. /.changes
+        itself lists the changes between consecutive snapshots, but any two
+        snapshots can be compared.
+        """
+        if len(components) == 1:
+            snapshots = self.get_snapshots()
+            for i in xrange(1, len(snapshots)):
+                name = "%s..%s" % (snapshots[i - 1], snapshots[i])
+                yield fuse.Direntry(name, ino = get_inode(CHANGES_DIR, [name]))
+        elif len(components) == 2 \
+                and self.parse_change_range(components[1]) is not None:
+            for change_type in CHANGE_TYPES:
+                yield fuse.Direntry(change_type, ino = get_inode(
+                        CHANGES_DIR, components[1:] + [change_type]))
+        else:
+            raise ValueError("Directory not found")
+
+    def open_changes(self, components):
+        """
+        Opens a change list under /.changes, given its components.
+        """
+        change_range = self.parse_change_range(components[1]) \
+            if len(components) == 3 else None
+        if change_range is None or components[2] not in CHANGE_TYPES:
+            raise ValueError("/".join(components) + " doesn't represent a file")
+        (from_ts, to_ts) = change_range
+        return StreamFileHandle(
+            lambda: self.generate_change_list(from_ts, to_ts, components[2]))
 
     # ----- FUSE API functions below -----
 
+    @timed("getattr")
     def getattr(self, path):
         """
         Return the attributes associated with PATH.
         """
         components = get_path_components(path)
 
-        if is_root(components) or is_snapshot_dir(components):
-            mtime = int(time.time())
-            mode = stat.S_IFDIR | 0555
-            size = 4096
-            return SnapshotFsStat(mtime, mode, 4096)
+        # Snapshots never change, so the root and snapshot directories get
+        # the time of the (latest) snapshot as their mtime, rather than the
+        # current time.
+        snapshots = self.get_snapshots()
+        mode = stat.S_IFDIR | 0555
+        if is_root(components):
+            mtime = self.snapshot_times[-1] if snapshots else 0
+            return SnapshotFsStat(mtime, mode, 4096, ino = 1)
+        if components == [STATS_FILE]:
+            # The size isn't known until the file is opened.
+            return SnapshotFsStat(time.time(), stat.S_IFREG | 0444, size = 0,
+                                  ino = get_inode(STATS_FILE, []))
+        if components[0] == CHANGES_DIR:
+            return self.getattr_changes(components)
+        if not self.is_snapshot(components[0]):
+            return -errno.ENOENT
+        if is_snapshot_dir(components):
+            return SnapshotFsStat(parse_timestamp(components[0]), mode, 4096,
+                                  ino = get_inode(components[0], []))
 
         # This is a file underneath a snapshot directory.
-        snapshots = self.get_snapshots()
         # Current snapshot?
         if components[0] == snapshots[-1]:
-            # The underlying file is in the mirror. Just return the attributes
-            # associated with that file.
-            return os.lstat(
+            # The underlying file is in the mirror. Return the attributes
+            # associated with that file, but with the same kind of inode
+            # number as in the other snapshots, so that it doesn't change
+            # when this snapshot becomes historical.
+            statresult = os.lstat(
                 os.path.join(self.repository_path, *components[1:]))
+            return SnapshotFsStat(
+                statresult.st_mtime, statresult.st_mode,
+                size = statresult.st_size, uid = statresult.st_uid,
+                gid = statresult.st_gid,
+                ino = get_inode(components[0], components[1:]),
+                nlink = statresult.st_nlink)
         else:
             # The file is in a historical snapshot. Construct the deferred
-            # directory and obtain the attributes from there.
-            file_info = self.get_deferred_dir(components[0], components[1:-1])
-            return file_info[components[-1]].getattr()
+            # directory and obtain the attributes from there, preferring the
+            # exact attributes recorded in rdiff-backup's metadata.
+            entry = self.get_deferred_file(components[0], components[1:])
+            # rdiff-backup's inode numbers are those of the source files,
+            # which are the same in every snapshot, so derive our own.
+            ino = get_inode(components[0], components[1:])
+            if self.mirror_metadata is not None:
+                file_metadata = self.mirror_metadata.get(
+                    components[0], components[1:])
+                if file_metadata is not None:
+                    return SnapshotFsStat(
+                        file_metadata.mtime, file_metadata.mode & ~0222,
+                        size = file_metadata.size, uid = file_metadata.uid,
+                        gid = file_metadata.gid, ino = ino,
+                        nlink = file_metadata.nlink)
+            return entry.getattr(self.gzip_index_cache,
+                                 parse_timestamp(components[0]), ino)
 
+    @timed_generator("readdir")
     def readdir(self, path, offset):
         """
         Lists the contents of a directory, returning a sequence of
         fuse.Direntry objects.
         """
+        components = get_path_components(path)
+        if not is_root(components) and self.is_snapshot(components[0]) \
+                and components[0] != self.get_snapshots()[-1]:
+            for direntry in self.readdir_historical(
+                    components[0], components[1:], offset):
+                yield direntry
+            return
+
         # Entries common to all directories.
         dir_entries = [ ".", ".." ]
         for p in dir_entries:
             yield fuse.Direntry(p)
 
-        components = get_path_components(path)
-
         if is_root(components):
             # Root directory. List all available snapshots.
             for snapshot_ts in self.get_snapshots():
-                yield fuse.Direntry(snapshot_ts)
+                yield fuse.Direntry(snapshot_ts,
+                                    ino = get_inode(snapshot_ts, []))
+            yield fuse.Direntry(CHANGES_DIR, ino = get_inode(CHANGES_DIR, []))
+            yield fuse.Direntry(STATS_FILE, ino = get_inode(STATS_FILE, []))
+            return
+        if components[0] == CHANGES_DIR:
+            for direntry in self.readdir_changes(components):
+                yield direntry
             return
 
         snapshots = self.get_snapshots()
-        if components[0] not in snapshots:
+        if not self.is_snapshot(components[0]):
             raise ValueError("Directory not found")
 
         # This is a file underneath a snapshot directory.
@@ -463,23 +3056,40 @@ class RdiffSnapshotFs(fuse.Fuse):
                 os.path.join(self.repository_path, *components[1:]))
             for filename in files:
                 if filename != "rdiff-backup-data":
-                    yield fuse.Direntry(filename)
-        else:
-            file_info = self.get_deferred_dir(components[0], components[1:])
-            for entry in file_info.values():
-                try:
-                    direntry = entry.get_direntry()
-                    yield direntry
-                except KeyError:
-                    pass
+                    yield fuse.Direntry(filename, ino = get_inode(
+                            components[0], components[1:] + [filename]))
+
+    def readdir_historical(self, snapshot_ts, relative_path, offset):
+        """
+        Lists a directory in a historical snapshot, starting at offset.
 
+        Entries are yielded straight from the directory's timeline; their
+        attributes aren't looked up until getattr asks for them. The offset
+        of each entry is its position in the timeline's sorted list of names
+        (after "." and ".."), so a listing that doesn't fit in one reply to
+        the kernel resumes where it left off instead of starting over.
+        """
+        timeline = self.get_directory_timeline(relative_path)
+        if self.prefetcher is not None and offset == 0:
+            self.prefetch_directory(snapshot_ts, relative_path)
+        for (i, name) in enumerate([".", ".."]):
+            if i >= offset:
+                yield fuse.Direntry(name, offset = i + 1)
+        for (i, name) in timeline.iter_names(parse_timestamp(snapshot_ts),
+                                             max(offset - 2, 0)):
+            yield fuse.Direntry(
+                name, offset = i + 3,
+                ino = get_inode(snapshot_ts, relative_path + [name]))
+
+    @timed("readlink")
     def readlink(self, path):
         """
         Return the attributes associated with PATH.
         """
         components = get_path_components(path)
 
-        if is_root(components) or is_snapshot_dir(components):
+        if is_root(components) or is_snapshot_dir(components) \
+                or components[0] == CHANGES_DIR:
             raise ValueError(path + " doesn't represent a link")
 
         # This is a file underneath a snapshot directory.
@@ -488,32 +3098,67 @@ class RdiffSnapshotFs(fuse.Fuse):
             return os.readlink(
                 os.path.join(self.repository_path, *components[1:]))
         else:
-            file_info = self.get_deferred_dir(components[0], components[1:-1])
-            return file_info[components[-1]].readlink()
+            return self.get_deferred_file(
+                components[0], components[1:]).readlink()
 
-    def read(self, path, size, offset):
+    @timed("read")
+    def read(self, path, size, offset, fh = None):
+        if fh is not None:
+            data = fh.read(size, offset)
+        else:
+            # No handle; open the file just for this read.
+            fh = self.open(path, os.O_RDONLY)
+            try:
+                data = fh.read(size, offset)
+            finally:
+                fh.release()
+        self.stats.count("bytes_served", len(data))
+        return data
+
+    @timed("open")
+    def open(self, path, flags):
+        """
+        Opens PATH, returning a handle object that is passed to read and
+        release. Resolving the file happens only once per open.
+        """
+        if flags & (os.O_WRONLY | os.O_RDWR):
+            return -errno.EROFS
         components = get_path_components(path)
 
+        if components == [STATS_FILE]:
+            data = json.dumps(self.get_stats(), indent = 2,
+                              sort_keys = True) + "\n"
+            return StreamFileHandle(lambda: iter([data]))
         if is_root(components) or is_snapshot_dir(components):
             raise ValueError(path + " doesn't represent a file")
+        if components[0] == CHANGES_DIR:
+            return self.open_changes(components)
 
+        handle_options = {
+            "direct_io": parse_bool_option(self.direct_io),
+            "keep_cache": parse_bool_option(self.keep_cache),
+            }
         # This is a file underneath a snapshot directory.
         snapshots = self.get_snapshots()
         if components[0] == snapshots[-1]: # Current snapshot?
-            fd = os.open(os.path.join(self.repository_path, *components[1:]),
-                         os.O_RDONLY)
-            try:
-                os.lseek(fd, offset, os.SEEK_SET)
-                return os.read(fd, size)
-            finally:
-                os.close(fd)
+            return FileHandle(
+                os.open(os.path.join(self.repository_path, *components[1:]),
+                        os.O_RDONLY),
+                **handle_options)
         else:
-            file_info = self.get_deferred_dir(components[0], components[1:-1])
-            return file_info[components[-1]].read(size, offset)
+            # Historical file data never changes, so the kernel may always
+            # keep it cached.
+            handle_options["keep_cache"] = \
+                not handle_options["direct_io"]
+            return self.get_deferred_file(
+                components[0], components[1:]).open(
+                self.materialization_cache, self.gzip_index_cache,
+                **handle_options)
 
-    def open(self, path, flags):
-        return 0
-    def release(self, path, flags):
+    @timed("release")
+    def release(self, path, flags, fh = None):
+        if fh is not None:
+            fh.release()
         return 0
     def truncate(self, path, size):
         return 0
@@ -534,16 +3179,465 @@ class RdiffSnapshotFs(fuse.Fuse):
     def rmdir(self, path):
         return -1
 
+class MultiRepositoryFs(RdiffSnapshotFs):
+    """
+    Filesystem that serves every rdiff-backup repository in a directory, as
+    /<repository>/<snapshot>/...
+
+    The repositories (RdiffSnapshotFs objects) share this filesystem's
+    caches (including the one for their mirror_metadata), materialization
+    store, worker pool and statistics, so the budgets set by the options
+    apply to all of them together. When the directory or materialization
+    cache is full, entries are evicted from the repository using the most of
+    it, so that one busy repository can't flush out the others. Repositories
+    that appear in or disappear from the directory are noticed within
+    snapshot_check_interval seconds.
+    """
+    # The options that the repositories take from this filesystem; the
+    # others configure the shared resources.
+    REPOSITORY_OPTIONS = ("snapshot_check_interval", "metadata",
+                          "direct_io", "keep_cache", "prefetch_max_file_size",
+                          "prefetch_bytes")
+
+    def __init__(self, repository_path, *args, **kw):
+        # Maps name -> RdiffSnapshotFs.
+        self.repositories = {}
+        self.repository_check_time = None
+        self.repository_lock = threading.Lock()
+        RdiffSnapshotFs.__init__(self, repository_path, *args, **kw)
+
+    def configure(self):
+        RdiffSnapshotFs.configure(self)
+        for repository in self.repositories.values():
+            repository.configure()
+
+    def configure_repository(self):
+        # The parent directory isn't a repository itself.
+        self.mirror_metadata = None
+        self.increment_db = None
+
+    def dir_cache_namespace(self, key):
+        # The repositories qualify their keys with their path (see
+        # CacheNamespace).
+        return key[0]
+
+    def file_cache_namespace(self, key):
+        "Returns the path of the repository that key (a path) is in."
+        name = os.path.relpath(key, self.repository_path).split(os.sep)[0]
+        return os.path.join(self.repository_path, name)
+
+    def close(self):
+        for repository in self.repositories.values():
+            repository.close()
+        RdiffSnapshotFs.close(self)
+
+    def get_repositories(self):
+        """
+        Returns a dict mapping names to repositories, rescanning the parent
+        directory at most every snapshot_check_interval seconds.
+        """
+        with self.repository_lock:
+            now = time.time()
+            if self.repository_check_time is None or now >= \
+                    self.repository_check_time \
+                    + float(self.snapshot_check_interval):
+                self.repository_check_time = now
+                self._scan_repositories()
+            return self.repositories
+
+    def _scan_repositories(self):
+        repositories = {}
+        for name in os.listdir(self.repository_path):
+            # Names starting with a dot are reserved for virtual files.
+            path = os.path.join(self.repository_path, name)
+            if name.startswith(".") or \
+                    not os.path.isdir(os.path.join(path, "rdiff-backup-data")):
+                continue
+            repository = self.repositories.get(name)
+            if repository is None:
+                repository = RdiffSnapshotFs(path, shared = self)
+            repositories[name] = repository
+        for (name, repository) in self.repositories.items():
+            if name not in repositories:
+                repository.close()
+                repository.deferred_dir_cache.clear()
+        self.repositories = repositories
+
+    def resolve(self, path):
+        """
+        Returns the name of the repository path is in, the repository and the
+        path within it. Raises OSError with ENOENT if there is no such
+        repository.
+        """
+        components = get_path_components(path)
+        repository = self.get_repositories().get(components[0])
+        if repository is None:
+            raise OSError(errno.ENOENT, os.strerror(errno.ENOENT))
+        return (components[0], repository, "/" + "/".join(components[1:]))
+
+    def repository_inode(self, name, ino):
+        """
+        Maps an inode number from the repository name to one that is unique
+        across the repositories. 0 (no inode number) is left alone.
+        """
+        if not ino:
+            return ino
+        return get_inode(name, [str(ino)])
+
+    # ----- FUSE API functions below -----
+
+    def getattr(self, path):
+        components = get_path_components(path)
+        if is_root(components):
+            return SnapshotFsStat(os.stat(self.repository_path).st_mtime,
+                                  stat.S_IFDIR | 0555, 4096, ino = 1)
+        if components == [STATS_FILE]:
+            return SnapshotFsStat(time.time(), stat.S_IFREG | 0444, size = 0,
+                                  ino = get_inode(STATS_FILE, []))
+        try:
+            (name, repository, inner_path) = self.resolve(path)
+        except OSError:
+            return -errno.ENOENT
+        result = repository.getattr(inner_path)
+        if isinstance(result, SnapshotFsStat):
+            result.st_ino = self.repository_inode(name, result.st_ino)
+        return result
+
+    def readdir(self, path, offset):
+        components = get_path_components(path)
+        if is_root(components):
+            for name in [".", ".."]:
+                yield fuse.Direntry(name)
+            for name in sorted(self.get_repositories()):
+                yield fuse.Direntry(name, ino = self.repository_inode(name, 1))
+            yield fuse.Direntry(STATS_FILE, ino = get_inode(STATS_FILE, []))
+            return
+        (name, repository, inner_path) = self.resolve(path)
+        for direntry in repository.readdir(inner_path, offset):
+            direntry.ino = self.repository_inode(name, direntry.ino)
+            yield direntry
+
+    def readlink(self, path):
+        (_, repository, inner_path) = self.resolve(path)
+        return repository.readlink(inner_path)
+
+    def open(self, path, flags):
+        if get_path_components(path) == [STATS_FILE]:
+            return RdiffSnapshotFs.open(self, path, flags)
+        (_, repository, inner_path) = self.resolve(path)
+        return repository.open(inner_path, flags)
+
+# Python 2 has neither sendfile nor copy_file_range, so exported files are
+# copied through user space, in large blocks.
+EXPORT_BUFFER_SIZE = 1024 * 1024
+
+def set_exported_attributes(path, file_metadata):
+    "Gives an exported file the ownership, mode and mtime in file_metadata."
+    if file_metadata.uid is not None and os.geteuid() == 0:
+        os.lchown(path, file_metadata.uid, file_metadata.gid)
+    if stat.S_ISLNK(file_metadata.mode):
+        # Python 2 can't set the mode or times of a symlink.
+        return
+    os.chmod(path, stat.S_IMODE(file_metadata.mode))
+    os.utime(path, (file_metadata.mtime, file_metadata.mtime))
+
+def export_file(job):
+    """
+    Writes one regular file of an export. Runs in a worker process, and
+    returns (destination, bytes written, error message or None).
+    """
+    (dest_file, backing_file, diffs, file_metadata) = job
+    try:
+        if diffs or backing_file.endswith(".gz"):
+            restore_file(backing_file, diffs, dest_file)
+        else:
+            with open(backing_file, 'rb') as source:
+                with open(dest_file, 'wb') as dest:
+                    shutil.copyfileobj(source, dest, EXPORT_BUFFER_SIZE)
+        set_exported_attributes(dest_file, file_metadata)
+        return (dest_file, os.lstat(dest_file).st_size, None)
+    except Exception as e:
+        return (dest_file, 0, str(e))
+
+def format_bytes(count):
+    "Returns a human-readable representation of a number of bytes."
+    for unit in ("B", "KiB", "MiB", "GiB"):
+        if count < 1024:
+            return "%.1f %s" % (count, unit)
+        count /= 1024.0
+    return "%.1f TiB" % count
+
+def export_snapshot(fs, snapshot_ts, relative_path, dest, processes,
+                    progress = None):
+    """
+    Copies relative_path, as of the given snapshot, to dest, reconstructing
+    files on a pool of processes. Reports progress to the file object
+    progress, if given, and errors to stderr. Returns the number of files
+    that couldn't be exported.
+    """
+    start_time = time.time()
+    plan = fs.plan_export(snapshot_ts, relative_path)
+    failures = [0]
+    def fail(path, message):
+        sys.stderr.write("%s: %s\n" % (path, message))
+        failures[0] += 1
+    # Create the directory structure and the symlinks up front; the regular
+    # files can then be written in any order.
+    directories = []
+    jobs = []
+    for (path, entry, file_metadata) in plan:
+        dest_path = os.path.join(dest, *path[len(relative_path):])
+        try:
+            if entry.file_type == DIRECTORY:
+                if not os.path.isdir(dest_path):
+                    os.mkdir(dest_path, 0700)
+                directories.append((dest_path, file_metadata))
+            elif entry.file_type == LINK:
+                os.symlink(entry.readlink(), dest_path)
+                set_exported_attributes(dest_path, file_metadata)
+            elif entry.file_type == REGULAR_FILE:
+                jobs.append(
+                    (file_metadata.size,
+                     (dest_path, entry.backing_file, list(entry.diffs),
+                      file_metadata)))
+        except (IOError, OSError) as e:
+            fail(dest_path, e)
+    # Start on the largest files first, so that one doesn't hold up the end
+    # of the export.
+    jobs.sort(key = lambda job: job[0], reverse = True)
+    total_bytes = sum(size for (size, _) in jobs)
+    done_files = 0
+    done_bytes = 0
+    last_report = 0
+    pool = multiprocessing.Pool(processes)
+    try:
+        for (dest_file, size, error) in pool.imap_unordered(
+                export_file, [job for (_, job) in jobs]):
+            if error is not None:
+                fail(dest_file, error)
+            done_files += 1
+            done_bytes += size
+            now = time.time()
+            if progress is not None \
+                    and (now - last_report >= 1 or done_files == len(jobs)):
+                last_report = now
+                progress.write(
+                    "\r%d/%d files, %s/%s, %s/s   " % (
+                        done_files, len(jobs), format_bytes(done_bytes),
+                        format_bytes(total_bytes),
+                        format_bytes(done_bytes / max(now - start_time,
+                                                      0.001))))
+                progress.flush()
+    except:
+        pool.terminate()
+        raise
+    else:
+        pool.close()
+    finally:
+        pool.join()
+    if progress is not None and jobs:
+        progress.write("\n")
+    # Set the directory attributes last, since writing their contents changes
+    # their mtimes, and deepest first, in case they aren't writable.
+    for (dest_path, file_metadata) in reversed(directories):
+        try:
+            set_exported_attributes(dest_path, file_metadata)
+        except OSError as e:
+            fail(dest_path, e)
+    return failures[0]
+
+def export_main(args):
+    "Runs the export command with the given arguments."
+    parser = optparse.OptionParser(
+        usage = "%prog export [options] <repository> <snapshot> <path> " +
+        "<destination>",
+        description = "Restores path (relative to the root of the " +
+        "repository), as of snapshot, to destination.")
+    parser.add_option(
+        "-j", "--jobs", type = "int", default = multiprocessing.cpu_count(),
+        help = "number of files to reconstruct in parallel " +
+        "[default: %default]")
+    parser.add_option(
+        "-q", "--quiet", action = "store_true", default = False,
+        help = "don't report progress")
+    (options, args) = parser.parse_args(args)
+    if len(args) != 4:
+        parser.error("wrong number of arguments")
+    (repository_path, snapshot_ts, path, dest) = args
+    fs = RdiffSnapshotFs(repository_path = os.path.abspath(repository_path))
+    try:
+        if not fs.is_snapshot(snapshot_ts):
+            parser.error("no such snapshot: " + snapshot_ts)
+        progress = None if options.quiet else sys.stderr
+        relative_path = [component for component in path.split("/")
+                         if component and component != "."]
+        try:
+            failures = export_snapshot(fs, snapshot_ts, relative_path, dest,
+                                       options.jobs, progress)
+        except OSError as e:
+            parser.error("%s: %s" % (path, e.strerror))
+    finally:
+        fs.close()
+    if failures:
+        sys.stderr.write("%d files could not be exported\n" % failures)
+        return 1
+    return 0
+
+# Options passed to FUSE unless given on the command line. use_ino makes the
+# kernel use our stable inode numbers.
+DEFAULT_FUSE_OPTIONS = [
+    ("use_ino", None),
+    ("entry_timeout", "300"),
+    ("attr_timeout", "300"),
+    ("negative_timeout", "60"),
+    ]
+
 def main(argv):
-    usage_msg = "Displays snapshots from rdiff-backup repositories."
-    fs = RdiffSnapshotFs(
-        repository_path = os.path.abspath(argv[1]),
+    if len(argv) > 1 and argv[1] == "export":
+        return export_main(argv[2:])
+    usage_msg = "Displays snapshots from rdiff-backup repositories. If the " + \
+        "given directory isn't a repository, every repository in it is " + \
+        "shown, as /<repository>/<snapshot>/..."
+    repository_path = os.path.abspath(argv[1])
+    if os.path.isdir(os.path.join(repository_path, "rdiff-backup-data")):
+        fs_class = RdiffSnapshotFs
+    else:
+        fs_class = MultiRepositoryFs
+    fs = fs_class(
+        repository_path,
         version = "rdiff-snapshot-fs 0.1",
         usage = usage_msg,
         dash_s_do = "setsingle")
-    fs.parse(errex = 1)
-    fs.multithreaded = False
-    fs.main()
+    fs.parser.add_option(
+        mountopt = "cache_entries", metavar = "N",
+        default = RdiffSnapshotFs.cache_entries,
+        help = "maximum number of deferred directories to cache " +
+        "[default: %default]")
+    fs.parser.add_option(
+        mountopt = "cache_bytes", metavar = "BYTES",
+        default = RdiffSnapshotFs.cache_bytes,
+        help = "approximate memory budget for cached deferred directories " +
+        "[default: %default]")
+    fs.parser.add_option(
+        mountopt = "negative_cache_entries", metavar = "N",
+        default = RdiffSnapshotFs.negative_cache_entries,
+        help = "maximum number of nonexistent paths to remember " +
+        "[default: %default]")
+    fs.parser.add_option(
+        mountopt = "materialize_dir", metavar = "DIR",
+        default = RdiffSnapshotFs.materialize_dir,
+        help = "directory for reconstructed historical files " +
+        "[default: a private temporary directory]")
+    fs.parser.add_option(
+        mountopt = "materialize_bytes", metavar = "BYTES",
+        default = RdiffSnapshotFs.materialize_bytes,
+        help = "disk budget for reconstructed historical files " +
+        "[default: %default]")
+    fs.parser.add_option(
+        mountopt = "materialize_persist", metavar = "BOOL",
+        default = RdiffSnapshotFs.materialize_persist,
+        help = "keep reconstructed files in materialize_dir across mounts " +
+        "[default: %default]")
+    fs.parser.add_option(
+        mountopt = "checkpoint_interval", metavar = "N",
+        default = RdiffSnapshotFs.checkpoint_interval,
+        help = "keep every Nth intermediate version when applying a chain " +
+        "of diffs; 0 disables checkpoints [default: %default]")
+    fs.parser.add_option(
+        mountopt = "checkpoint_bytes", metavar = "BYTES",
+        default = RdiffSnapshotFs.checkpoint_bytes,
+        help = "disk budget for intermediate version checkpoints " +
+        "[default: %default]")
+    fs.parser.add_option(
+        mountopt = "gzip_index_entries", metavar = "N",
+        default = RdiffSnapshotFs.gzip_index_entries,
+        help = "maximum number of gzip random-access indexes to keep " +
+        "[default: %default]")
+    fs.parser.add_option(
+        mountopt = "gzip_index_span", metavar = "BYTES",
+        default = RdiffSnapshotFs.gzip_index_span,
+        help = "distance between gzip index checkpoints " +
+        "[default: %default]")
+    fs.parser.add_option(
+        mountopt = "gzip_index_bytes", metavar = "BYTES",
+        default = RdiffSnapshotFs.gzip_index_bytes,
+        help = "approximate memory budget for gzip index checkpoints " +
+        "[default: %default]")
+    fs.parser.add_option(
+        mountopt = "snapshot_check_interval", metavar = "SECONDS",
+        default = RdiffSnapshotFs.snapshot_check_interval,
+        help = "how often to check the repository for new snapshots " +
+        "[default: %default]")
+    fs.parser.add_option(
+        mountopt = "increment_index", metavar = "FILE",
+        default = RdiffSnapshotFs.increment_index,
+        help = "keep a persistent index of the increments in this SQLite " +
+        "database (or, when serving several repositories, in a database " +
+        "per repository in this directory) " +
+        "[default: scan directories on demand]")
+    fs.parser.add_option(
+        mountopt = "metadata", metavar = "BOOL",
+        default = RdiffSnapshotFs.metadata,
+        help = "use the file attributes recorded in rdiff-backup's " +
+        "mirror_metadata files [default: %default]")
+    fs.parser.add_option(
+        mountopt = "reconstruction_workers", metavar = "N",
+        default = RdiffSnapshotFs.reconstruction_workers,
+        help = "maximum number of historical files to reconstruct at once " +
+        "[default: %default]")
+    fs.parser.add_option(
+        mountopt = "direct_io", metavar = "BOOL",
+        default = RdiffSnapshotFs.direct_io,
+        help = "bypass the kernel page cache for file data " +
+        "[default: %default]")
+    fs.parser.add_option(
+        mountopt = "keep_cache", metavar = "BOOL",
+        default = RdiffSnapshotFs.keep_cache,
+        help = "keep cached file data in the kernel across opens of files " +
+        "in the current snapshot (always on for historical snapshots) " +
+        "[default: %default]")
+    fs.parser.add_option(
+        mountopt = "prefetch", metavar = "BOOL",
+        default = RdiffSnapshotFs.prefetch,
+        help = "after listing a historical directory, warm the caches for " +
+        "its subdirectories and small files [default: %default]")
+    fs.parser.add_option(
+        mountopt = "prefetch_workers", metavar = "N",
+        default = RdiffSnapshotFs.prefetch_workers,
+        help = "number of threads used for prefetching [default: %default]")
+    fs.parser.add_option(
+        mountopt = "prefetch_max_file_size", metavar = "BYTES",
+        default = RdiffSnapshotFs.prefetch_max_file_size,
+        help = "only prefetch files up to this size [default: %default]")
+    fs.parser.add_option(
+        mountopt = "prefetch_bytes", metavar = "BYTES",
+        default = RdiffSnapshotFs.prefetch_bytes,
+        help = "maximum amount of file data to prefetch per directory " +
+        "listed [default: %default]")
+    fs.parser.add_option(
+        mountopt = "stats_log", metavar = "FILE",
+        default = RdiffSnapshotFs.stats_log,
+        help = "periodically append the contents of /.stats to FILE, as a " +
+        "line of JSON [default: don't]")
+    fs.parser.add_option(
+        mountopt = "stats_interval", metavar = "SECONDS",
+        default = RdiffSnapshotFs.stats_interval,
+        help = "how often to write to stats_log [default: %default]")
+    # All shared state is protected by locks, so the filesystem runs
+    # multithreaded unless -s is given.
+    fs.parse(values = fs, errex = 1)
+    fs.configure()
+    # Everything except the current snapshot is immutable, so let the kernel
+    # cache lookups and attributes for a long time. These timeouts apply to
+    # the whole mount; they can be overridden with -o.
+    for (option, value) in DEFAULT_FUSE_OPTIONS:
+        if option not in fs.fuse_args.optdict \
+                and option not in fs.fuse_args.optlist:
+            fs.fuse_args.add(option, value)
+    try:
+        fs.main()
+    finally:
+        fs.close()
 
 if __name__ == "__main__":
-    main(sys.argv)
+    sys.exit(main(sys.argv))